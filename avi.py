@@ -0,0 +1,293 @@
+import mmap
+import os
+import struct
+
+import numpy as np
+
+
+# ffmpeg starts a new RIFF (OpenDML) list after 1GB
+max_riff_size = 1 << 30
+# 0x000001B6 starts a VOP (an MPEG-4 part 2 frame),
+# and the top 2 bits of the next byte are its coding type
+vop_start_code = bytes.fromhex('000001B6')
+vop_types = b'IPBS'
+# idx1 flag for keyframes
+keyframe_flag = 0x10
+# ix## entries have this bit set for frames that aren't keyframes
+not_keyframe_bit = 1 << 31
+
+frame_dtype = np.dtype([
+    # where the chunk header starts
+    ('offset', 'u8'),
+    # the size of the chunk's data (not counting the header or padding)
+    ('size', 'u4'),
+    # I, P, B, S (sprite), or N for an empty (dropped) frame
+    ('type', 'S1'),
+])
+
+def walk_chunks(mm, start, end):
+    '''
+    Iterate over the (fourcc, offset, size) of the RIFF chunks between start and end.
+    '''
+    pos = start
+    end = min(end, len(mm))
+    while pos + 8 <= end:
+        fourcc = bytes(mm[pos:pos+4])
+        size, = struct.unpack_from('<I', mm, pos+4)
+        yield fourcc, pos, size
+        pos += 8 + size + (size & 1)
+
+
+def get_chunk_span(size):
+    '''
+    How many bytes a chunk takes up in the file, with its header and padding.
+    '''
+    return 8 + size + (size & 1)
+
+
+def get_frame_type(payload):
+    if not payload:
+        return b'N'
+    vop = payload.find(vop_start_code)
+    if vop < 0 or vop + 4 >= len(payload):
+        # no VOP header, so it's just stream headers
+        return b'I'
+    coding_type = payload[vop+4] >> 6
+    return vop_types[coding_type:coding_type+1]
+
+
+def index_hdrl(mm, start, end, header):
+    '''
+    Find the header fields that change when the frames change.
+    '''
+    for fourcc, pos, size in walk_chunks(mm, start, end):
+        data = pos + 8
+        if fourcc == b'LIST':
+            index_hdrl(mm, data + 4, data + size, header)
+        elif fourcc == b'avih':
+            header['avih_total_frames'] = data + 16
+        elif fourcc == b'strh' and mm[data:data+4] == b'vids':
+            if 'strh_length' in header:
+                raise ValueError('Only AVIs with a single video stream are supported')
+            header['strh_length'] = data + 32
+        elif fourcc == b'strh':
+            raise ValueError('Only AVIs with a single video stream are supported')
+        elif fourcc == b'dmlh':
+            header['dmlh_total_frames'] = data
+        elif fourcc == b'indx':
+            header['indx'] = pos
+            header['indx_capacity'] = (size - 24) // 16
+
+
+def index_avi(path):
+    '''
+    Walk the RIFF/movi structure of an AVI (via mmap, without reading the frames)
+    and return the header positions and a frame_dtype array of every video frame.
+    '''
+    header = {}
+    frames = []
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for fourcc, riff_pos, riff_size in walk_chunks(mm, 0, len(mm)):
+            if fourcc != b'RIFF':
+                continue
+            form = bytes(mm[riff_pos+8:riff_pos+12])
+            for fourcc, pos, size in walk_chunks(mm, riff_pos + 12, riff_pos + 8 + riff_size):
+                list_type = bytes(mm[pos+8:pos+12])
+                if form == b'AVI ' and fourcc == b'LIST' and list_type == b'hdrl':
+                    index_hdrl(mm, pos + 12, pos + 8 + size, header)
+                if fourcc != b'LIST' or list_type != b'movi':
+                    continue
+                if form == b'AVI ':
+                    # everything up to here gets copied as is
+                    header['movi'] = pos + 8
+                for fourcc, chunk_pos, chunk_size in walk_chunks(mm, pos + 12, pos + 8 + size):
+                    if fourcc in (b'00dc', b'00db'):
+                        payload = mm[chunk_pos+8:chunk_pos+8+min(chunk_size, 256)]
+                        frames.append((chunk_pos, chunk_size, get_frame_type(payload)))
+                    elif fourcc[2:] in (b'dc', b'db', b'wb'):
+                        raise ValueError('Only AVIs with a single video stream are supported')
+    if 'movi' not in header:
+        raise ValueError(f'{path} has no movi list')
+    return {
+        'path'   : path,
+        'header' : header,
+        'frames' : np.array(frames, dtype=frame_dtype),
+    }
+
+
+def copy_span(src_fd, out_file, offset, count):
+    '''
+    Copy bytes from one file to the end of another, in the kernel when we can.
+    '''
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while count > 0:
+                copied = os.copy_file_range(src_fd, out_file.fileno(), count, offset)
+                if not copied:
+                    break
+                offset += copied
+                count -= copied
+        except OSError:
+            # e.g. across filesystems (EXDEV) or on ones that can't (EINVAL, ENOSYS, EOPNOTSUPP),
+            # so copy the rest ourselves
+            pass
+    while count > 0:
+        block = os.pread(src_fd, min(count, 1 << 24), offset)
+        if not block:
+            raise ValueError('Unexpected end of file while copying frames')
+        out_file.write(block)
+        offset += len(block)
+        count -= len(block)
+
+
+def start_list(out_file, tag, list_type):
+    '''
+    Write a RIFF/LIST header with a placeholder size, returning where the size goes.
+    '''
+    size_pos = out_file.tell() + 4
+    out_file.write(tag + b'\0\0\0\0' + list_type)
+    return size_pos
+
+
+def end_list(out_file, size_pos):
+    end = out_file.tell()
+    out_file.seek(size_pos)
+    out_file.write(struct.pack('<I', end - size_pos - 4))
+    out_file.seek(end)
+
+
+def write_frames(out_file, src_fds, sources, plan):
+    '''
+    Copy the planned frames to the end of out_file, merging runs of adjacent chunks
+    into single copies. Returns each frame's new chunk offset.
+    '''
+    offsets = np.empty(len(plan), dtype='u8')
+    run_src = run_start = run_end = None
+    for i, (source_num, frame_num) in enumerate(plan):
+        frame = sources[source_num]['frames'][frame_num]
+        start = int(frame['offset'])
+        span = get_chunk_span(int(frame['size']))
+        if source_num != run_src or start != run_end:
+            if run_src is not None:
+                copy_span(src_fds[run_src], out_file, run_start, run_end - run_start)
+            run_src, run_start = source_num, start
+        offsets[i] = out_file.tell() + (start - run_start)
+        run_end = start + span
+    if run_src is not None:
+        copy_span(src_fds[run_src], out_file, run_start, run_end - run_start)
+    return offsets
+
+
+def write_ix(out_file, offsets, sizes, is_key, base):
+    '''
+    Write an OpenDML standard index chunk for one movi list.
+    '''
+    entries = np.empty((len(offsets), 2), dtype='<u4')
+    entries[:, 0] = offsets + 8 - base
+    entries[:, 1] = sizes | np.where(is_key, 0, not_keyframe_bit).astype('u4')
+    ix_pos = out_file.tell()
+    out_file.write(b'ix00' + struct.pack(
+        '<IHBBI4sQI', 24 + entries.nbytes,
+        2, 0, 1, len(offsets), b'00dc', base, 0
+    ))
+    out_file.write(entries.tobytes())
+    return ix_pos, 8 + 24 + entries.nbytes
+
+
+def write_idx1(out_file, offsets, sizes, is_key, movi):
+    entries = np.empty((len(offsets), 4), dtype='<u4')
+    entries[:, 0] = struct.unpack('<I', b'00dc')[0]
+    entries[:, 1] = np.where(is_key, keyframe_flag, 0)
+    entries[:, 2] = offsets - movi
+    entries[:, 3] = sizes
+    out_file.write(b'idx1' + struct.pack('<I', entries.nbytes))
+    out_file.write(entries.tobytes())
+
+
+def write_avi(out_path, sources, plan):
+    '''
+    Write a new AVI made of frames from indexed AVIs (see index_avi),
+    streaming the frame data straight from the source files.
+    `plan` lists the (source number, frame number) of each output frame;
+    the headers come from the first source.
+    Each movi list gets fresh indexes, and the frame counts are updated.
+    '''
+    plan = np.asarray(plan, dtype=int).reshape(-1, 2)
+    header = sources[0]['header']
+    is_odml = 'indx' in header
+    sizes = np.array([ sources[s]['frames'][f]['size'] for s, f in plan ], dtype='u4')
+    is_key = np.array([ sources[s]['frames'][f]['type'] == b'I' for s, f in plan ], dtype=bool)
+    spans = sizes.astype('u8') + 8 + (sizes & 1)
+
+    # split the frames into RIFF lists like ffmpeg does:
+    # a new one starts once a frame would begin past max_riff_size
+    riffs = []
+    start = 0
+    # where the first frame lands, relative to the RIFF data
+    riff_pos = header['movi'] - 4
+    while start < len(plan) or not riffs:
+        if is_odml:
+            frame_pos = riff_pos + np.cumsum(spans[start:]) - spans[start:]
+            ends = np.flatnonzero(frame_pos > max_riff_size)
+            end = start + max(int(ends[0]), 1) if len(ends) else len(plan)
+        else:
+            end = len(plan)
+        riffs.append((start, end))
+        start = end
+        # after the AVIX form type and movi list header
+        riff_pos = 4 + 12
+    if is_odml and len(riffs) > header['indx_capacity']:
+        raise ValueError(f'Too many RIFF lists ({len(riffs)}) for the OpenDML index')
+    if not is_odml and header['movi'] + spans.sum() + 16*len(plan) >= 1 << 32:
+        raise ValueError('Output is too big for an AVI without an OpenDML index')
+
+    src_files = [ open(source['path'], 'rb') for source in sources ]
+    src_fds = [ f.fileno() for f in src_files ]
+    ix_entries = []
+    try:
+        # unbuffered, so our writes and the kernel copies share a file position
+        with open(out_path, 'wb', buffering=0) as out_file:
+            # the header, up to the start of the first movi list
+            copy_span(src_fds[0], out_file, 0, header['movi'] - 8)
+            for riff_num, (start, end) in enumerate(riffs):
+                if riff_num == 0:
+                    riff_size_pos = 4
+                    movi_size_pos = out_file.tell() + 4
+                    out_file.write(b'LIST\0\0\0\0movi')
+                else:
+                    riff_size_pos = start_list(out_file, b'RIFF', b'AVIX')
+                    movi_size_pos = start_list(out_file, b'LIST', b'movi')
+                movi = movi_size_pos + 4
+                offsets = write_frames(out_file, src_fds, sources, plan[start:end])
+                if is_odml:
+                    ix_pos, ix_size = write_ix(
+                        out_file, offsets, sizes[start:end], is_key[start:end], movi
+                    )
+                    ix_entries.append((ix_pos, ix_size, end - start))
+                end_list(out_file, movi_size_pos)
+                if riff_num == 0:
+                    write_idx1(out_file, offsets, sizes[start:end], is_key[start:end], movi)
+                    first_riff_frames = end - start
+                end_list(out_file, riff_size_pos)
+
+            # update the frame counts and the OpenDML super index
+            def patch(pos, fmt, *values):
+                out_file.seek(pos)
+                out_file.write(struct.pack(fmt, *values))
+            total_frames = len(plan)
+            patch(header['avih_total_frames'], '<I', first_riff_frames if is_odml else total_frames)
+            if 'strh_length' in header:
+                patch(header['strh_length'], '<I', total_frames)
+            if 'dmlh_total_frames' in header:
+                patch(header['dmlh_total_frames'], '<I', total_frames)
+            if is_odml:
+                indx = header['indx']
+                patch(indx + 12, '<I', len(ix_entries))
+                for i, entry in enumerate(ix_entries):
+                    patch(indx + 32 + 16*i, '<QII', *entry)
+                # clear any old entries we didn't overwrite
+                unused = header['indx_capacity'] - len(ix_entries)
+                patch(indx + 32 + 16*len(ix_entries), f'<{4*unused}I', *([0] * 4*unused))
+    finally:
+        for f in src_files:
+            f.close()
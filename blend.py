@@ -0,0 +1,65 @@
+import numpy as np
+
+
+# scratch space, reused between calls with the same shape
+scratch = {}
+
+def get_scratch(name, shape, dtype='uint16'):
+    key = (name, shape, dtype)
+    if key not in scratch:
+        scratch[key] = np.empty(shape, dtype=dtype)
+    return scratch[key]
+
+
+def to_alpha(pct):
+    '''
+    Convert a 0-1 fade percentage to a 0-255 alpha.
+    '''
+    return int(round(pct * 255))
+
+
+def divide_255(total, out):
+    '''
+    Round uint16 values in [0, 255*255] divided by 255 into the uint8 `out`.
+    (Overwrites `total`.)
+    '''
+    part = get_scratch('divide', total.shape)
+    # (x + 128 + ((x + 128) >> 8)) >> 8 is exactly round(x / 255)
+    np.add(total, 128, out=total)
+    np.right_shift(total, 8, out=part)
+    np.add(total, part, out=total)
+    np.right_shift(total, 8, out=total)
+    np.copyto(out, total, casting='unsafe')
+    return out
+
+
+def blend(mask, foreground, background, out=None):
+    '''
+    foreground*mask + background*(1-mask) in 8-bit fixed point.
+    `mask` is a uint8 alpha (0-255) array or a scalar alpha (see `to_alpha`);
+    a single channel mask is broadcast over the channels of the images,
+    and the foreground/background can also be scalars.
+    The result is written into `out` (which may be the foreground or background).
+    '''
+    if np.ndim(mask) == 0:
+        inverse = 255 - mask
+    else:
+        if np.ndim(mask) < max(np.ndim(foreground), np.ndim(background)):
+            mask = mask[..., np.newaxis]
+        inverse = np.subtract(255, mask, out=get_scratch('inverse', mask.shape, 'uint8'))
+    shape = np.broadcast_shapes(np.shape(mask), np.shape(foreground), np.shape(background))
+    if out is None:
+        out = np.empty(shape, dtype='uint8')
+    total = get_scratch('total', shape)
+    part = get_scratch('part', shape)
+    np.multiply(foreground, mask, out=total, dtype='uint16')
+    np.multiply(background, inverse, out=part, dtype='uint16')
+    np.add(total, part, out=total)
+    return divide_255(total, out)
+
+
+def scale(mask, pct, out=None):
+    '''
+    Fade a uint8 mask by a 0-1 percentage.
+    '''
+    return blend(to_alpha(pct), mask, 0, out=out)
@@ -1,203 +1,204 @@
-from multiprocessing import freeze_support, set_start_method
-import os
-import shutil
+from functools import partial
+from multiprocessing import Pool, freeze_support, set_start_method
 import subprocess
 
-from tqdm import trange
+from tqdm import tqdm
 
+from blend import blend, divide_255, to_alpha
 from credits import *
 from extract import *
 from glitch import *
 from params import *
+from schedule import COPY, FIRE, get_trail_warmup, plan_interweave
+from stages import run_stages, stage
 
 
-def interweave():
-    if os.path.exists('media/frames/interweaved'):
-        return
-    prinnit('Interweaving fire, wave masking, randomizing...')
-    subprocess.run('mkdir -p media/frames/interweaved', check=True, shell=True)
-
-    # sometimes the real value does not equal the theoretical value...
-    total_frames = get_num_dancer_frames()
-
-    dancer_frames_start = 60
-    dancer_frames_slow = 30
-    dancer_frames_fast = 3
-
-    # once the verse enters,
-    # move the dancer into random chaos and back out in one verse, peaking at...
-    random_bars = 12
-    # the maximum random radius of frames around the current frame
-    max_deviation = 15
-
-    fire_sections = [
-        # start with infrequent fire frames, increasing linearly up to stage reveal, then disappear
-        [ 0, np.linspace(dancer_frames_start, dancer_frames_slow, num=s_to_f(bass_synth_start)).astype(int), 1 ],
-        # reappear at chorus, oscillate to high intensity two times
-        [ chorus1_start, oscillate(dancer_frames_slow, dancer_frames_fast, chorus1_duration / 2, how_many=2, offset=1).astype(int), 1 ],
-        # same at 2nd chorus (twice length)
-        [ chorus2_start, oscillate(dancer_frames_slow, dancer_frames_fast, chorus1_duration / 2, how_many=4, offset=1).astype(int), 1 ],
-    ]
+def get_interweave_mask(schedule, frame_num, out):
+    '''
+    The dancer alpha mask for an interweaved frame, with the background faded in.
+    (May be the cached mask itself, or written into `out`.)
+    '''
+    mask = get_mask(schedule['mask_frame'][frame_num] + 1, as_alpha=True)
+    background_pct = schedule['background_pct'][frame_num]
+    if np.isnan(background_pct):
+        return mask
+    background_alpha = to_alpha(background_pct)
+    # the mask faded in, clipped at full alpha
+    np.minimum(mask, 255 - background_alpha, out=out)
+    np.add(out, background_alpha, out=out)
+    return blend(mask, out, background_alpha, out=out)
+
+
+def create_trail(capacity, shape=frame_shape):
+    '''
+    A ring buffer holding the last `capacity` dancer alpha masks,
+    plus scratch space for combining them.
+    '''
+    return {
+        'planes' : np.zeros((capacity, *shape), dtype='uint8'),
+        # where the next mask goes
+        'head'   : 0,
+        'size'   : 0,
+        'scaled' : np.empty(shape, dtype='uint16'),
+        'max'    : np.empty(shape, dtype='uint16'),
+    }
+
+
+def push_trail(trail, mask):
+    capacity = len(trail['planes'])
+    trail['planes'][trail['head']] = mask
+    trail['head'] = (trail['head'] + 1) % capacity
+    trail['size'] = min(trail['size'] + 1, capacity)
+
+
+def get_trail_max(trail, trail_len, decay, out):
+    '''
+    The max of the newest `trail_len` masks, each faded by its age's decay alpha.
+    '''
+    capacity = len(trail['planes'])
+    trail_max = trail['max']
+    scaled = trail['scaled']
+    for age in range(min(trail_len, trail['size'])):
+        plane = trail['planes'][(trail['head'] - 1 - age) % capacity]
+        if age == 0:
+            np.multiply(plane, decay[age], out=trail_max, dtype='uint16')
+        else:
+            np.multiply(plane, decay[age], out=scaled, dtype='uint16')
+            np.maximum(trail_max, scaled, out=trail_max)
+    return divide_255(trail_max, out)
 
-    # after verse, oscillate random dancer deviation
-    total_random_frames = total_frames - verse1_start_frame
-    deviation_radius = oscillate(0, max_deviation, bar_dur * random_bars, num_frames=total_random_frames, offset=-1)
-    deviation_radius = np.rint(deviation_radius)
-    random_deviation = np.random.rand(total_random_frames) * deviation_radius*2 - deviation_radius
-    random_deviation = random_deviation.astype(int)
-
-    # use the dancer mask
-    mask_start_frame = guitar_start_frame + s_to_f(bar_dur*4)
-    # to fade out background by verse start
-    fade1_end_frame = verse1_start_frame
-    mask_fade1_pct = np.linspace(1, 0, num=fade1_end_frame - mask_start_frame)
-    # fade in waves over dancer by verse start
-    waves_fade_in1_pct = np.linspace(0, 1, num=fade1_end_frame - dancer_entrance_frame)
-    mask_fade2_pct = np.linspace(0, 0.9, num=fade2_end_frame - fade2_start_frame)
+
+def render_interweave_frames(schedule, frame_range):
+    '''
+    Render the interweaved frames in [start, end),
+    following the decisions in the schedule.
+    Returns the number of frames and the mask cache hits/misses.
+    '''
+    start, end = frame_range
+    cache_start = get_mask_cache_info()
+    mask_buffer = np.empty(frame_shape, dtype='uint8')
+    motion_buffer = np.empty(frame_shape, dtype='uint8')
 
     # on the 2nd verse, make a fire motion trail
-    dancer_motion_history = np.empty((720,1280,0))
-    # the trail is at most a bar
-    fire_trail_max_memory = s_to_f(bar_dur)
+    dancer_motion_history = create_trail(fire_trail_max_memory)
     # and it fades out
-    fire_trail_decay = (
-        np.arange(fire_trail_max_memory, 0, -1) / fire_trail_max_memory
-    ).reshape((1,1,-1))
-    # but it grows with the guitar crashes and shrinks as they fade
-    fire_trail_memory = oscillate(
-        0, fire_trail_max_memory, fire_trail_memory_fade,
-        num_frames=fire_trail_dur, offset=-1
-    ).astype(int)
-
-    fire_section = 0
-    for frame_num in trange(total_frames):
+    fire_trail_decay = np.array([
+        to_alpha(memory / fire_trail_max_memory)
+        for memory in range(fire_trail_max_memory, 0, -1)
+    ], dtype='uint8')
+    # rebuild the trail left by the frames before this range
+    if np.any(schedule['trail_len'][start:end]):
+        for frame_num in get_trail_warmup(schedule, start):
+            mask = get_interweave_mask(schedule, frame_num, mask_buffer)
+            push_trail(dancer_motion_history, mask)
+
+    interweaved = get_frame_store('interweaved')
+    fire = get_frame_store('fire')
+    dancers = get_frame_store('dancers')
+    # the outro dancers are keyed over waves (see key_outro_dancers)
+    outro_dancers = get_frame_store('outro_dancers')
+    outro_start_frame = s_to_f(outro_start) + 1
+    fire_trail = get_frame_store('fire_trail')
+    for frame_num in range(start, end):
         out_frame = frame_num+1
-        in_file = f'{out_frame:06d}.png'
-        out_file = f'media/frames/interweaved/{in_file}'
-        fire_frame = f'media/frames/fire/{in_file}'
-
-        fire_section_start, dancer_rates, num_fire_frames = fire_sections[fire_section]
-        fire_section_start_frame = s_to_f(fire_section_start)
-        fire_section_end_frame = fire_section_start_frame + len(dancer_rates)
-        is_fire_section = frame_num >= fire_section_start_frame and frame_num < fire_section_end_frame
-        if is_fire_section:
-            if frame_num == fire_section_start_frame:
-                dancer_frame_count = 0
-                fire_frame_count = 0
-            if frame_num == fire_section_end_frame - 1 and fire_section + 1 < len(fire_sections):
-                fire_section += 1
-
-            num_dancer_frames = dancer_rates[frame_num - fire_section_start_frame]
-            is_fire = dancer_frame_count >= num_dancer_frames
-            if is_fire:
-                fire_frame_count += 1
-                if fire_frame_count >= num_fire_frames:
-                    dancer_frame_count = 0
-                    fire_frame_count = 0
-                shutil.copyfile(fire_frame, out_file)
-                continue
-
-            dancer_frame_count += 1
+        source = schedule['source'][frame_num]
+
+        if source == FIRE:
+            interweaved.copy(fire, out_frame)
+            continue
 
         # before dancer enters,
         # and after cut to multiple dancers,
         # just copy the original image
-        dancer_file = f'media/frames/dancers/{in_file}'
-        if frame_num < dancer_entrance_frame or frame_num >= s_to_f(synth_arp_start):
-            shutil.copyfile(dancer_file, out_file)
+        if source == COPY:
+            interweaved.copy(outro_dancers if out_frame >= outro_start_frame else dancers, out_frame)
             continue
 
         # after dancer enters, blend waves with dancer
+        wave_offset = schedule['wave_offset'][frame_num]
+        wave_is_slow = schedule['wave_is_slow'][frame_num]
         if frame_num < fade2_end_frame:
-            if frame_num < fade2_start_frame:
-                wave_file = get_wave_file(frame_num - dancer_entrance_frame)
-            else:
-                wave_file = get_wave_file(frame_num - fade2_start_frame, is_slow=True)
-            waves = cv2.imread(wave_file)
-            if frame_num < fade1_end_frame:
-                dancer_original = cv2.imread(dancer_file)
-                waves_pct = waves_fade_in1_pct[frame_num - dancer_entrance_frame]
-                dancer = cv2.addWeighted(waves, waves_pct, dancer_original, 1 - waves_pct, 0)
-            else:
-                dancer = waves
+            dancer = get_wave_frame(wave_offset, is_slow=wave_is_slow)
+            waves_pct = schedule['waves_pct'][frame_num]
+            if not np.isnan(waves_pct):
+                dancer_original = dancers[out_frame]
+                blend(to_alpha(waves_pct), dancer, dancer_original, out=dancer)
         else:
-            dancer = cv2.imread(dancer_file)
+            dancer = dancers[out_frame]
 
         # before we have the dancer mask, just write the blended image
-        if frame_num < mask_start_frame:
-            cv2.imwrite(out_file, dancer)
+        if schedule['mask_frame'][frame_num] < 0:
+            interweaved[out_frame] = dancer
             continue
 
-        # at the first verse, start choosing dancer masks randomly
-        # within a window around the playhead
-        if frame_num < verse1_start_frame:
-            mask_frame = frame_num
-        else:
-            dancer_deviation = random_deviation[frame_num - verse1_start_frame]
-            mask_frame = frame_num + dancer_deviation
-            mask_frame = max(mask_frame, 0)
-            mask_frame = min(mask_frame, total_frames)
-        mask_file = f'media/frames/dancers_mask/{mask_frame+1:06d}.npy'
-
-        # after we have a mask...
-        if os.path.exists(mask_file):
-            mask = get_mask(mask_file)
-            # if the pose wasn't found, use the last mask available
-            last_mask = mask
-        # fade out the background
-        is_fade1 = frame_num < fade1_end_frame
-        is_fade2 = fade2_start_frame <= frame_num < fade2_end_frame
-        if is_fade1 or is_fade2:
-            if is_fade1:
-                background_pct = mask_fade1_pct[frame_num - mask_start_frame]
-            else:
-                background_pct = mask_fade2_pct[frame_num - fade2_start_frame]
-            background_fade = np.full(last_mask.shape, background_pct)
-            mask_fade_in = np.clip(last_mask + background_pct, 0, 1)
-            mask = apply_mask(last_mask, mask_fade_in, background_fade, is_img=False)
-        else:
-            mask = last_mask
+        mask = get_interweave_mask(schedule, frame_num, mask_buffer)
 
         # on the 2nd verse, make a fire motion trail
-        has_fire_trail = fire_trail_start <= frame_num < fire_trail_end
-        if has_fire_trail:
-            trail_len = min(
-                fire_trail_memory[frame_num - fire_trail_start],
-                dancer_motion_history.shape[2]
-            )
-            if trail_len < 1:
-                has_fire_trail = False
-            else:
-                trail = dancer_motion_history[:,:,:trail_len]
-                decay = fire_trail_decay[:,:,:trail_len]
-                motion_mask = trail * decay
-                motion_mask = np.amax(motion_mask, axis=2)
-                # let the dancer come thru
-                motion_mask = (1-mask) * motion_mask
-                motion_mask = np.stack((motion_mask,)*3, axis=-1)
-            dancer_motion_history = np.dstack((mask, dancer_motion_history))
-            if dancer_motion_history.shape[2] > fire_trail_max_memory:
-                dancer_motion_history = dancer_motion_history[:,:,:fire_trail_max_memory]
-
-        mask = np.stack((mask,)*3, axis=-1)
+        trail_len = schedule['trail_len'][frame_num]
+        if trail_len:
+            motion_mask = get_trail_max(dancer_motion_history, trail_len, fire_trail_decay, motion_buffer)
+            # let the dancer come thru
+            blend(mask, 0, motion_mask, out=motion_mask)
+        if schedule['trail_push'][frame_num]:
+            push_trail(dancer_motion_history, mask)
+
         # after fade, overlay dancer directly on waves
         if frame_num >= fade2_end_frame:
-            wave_file = get_wave_file(frame_num - fade2_start_frame, is_slow=True)
-            waves = cv2.imread(wave_file)
-            dancer_final = apply_mask(mask, dancer, waves)
+            waves = get_wave_frame(wave_offset, is_slow=wave_is_slow)
+            dancer_final = blend(mask, dancer, waves, out=dancer)
         else:
-            dancer_final = np.asarray(dancer * mask, dtype='uint8')
+            dancer_final = blend(mask, dancer, 0, out=dancer)
+
+        if trail_len:
+            blend(motion_mask, fire_trail[out_frame], dancer_final, out=dancer_final)
 
-        if has_fire_trail:
-            fire = cv2.imread(f'media/frames/fire_trail/{in_file}')
-            dancer_final = apply_mask(motion_mask, fire, dancer_final)
+        interweaved[out_frame] = dancer_final
 
-        cv2.imwrite(out_file, dancer_final)
+    cache_end = get_mask_cache_info()
+    return end - start, cache_end.hits - cache_start.hits, cache_end.misses - cache_start.misses
 
 
+@stage(
+    outputs=[get_frame_store_path('interweaved')],
+    deps=[
+        'extract_fire_frames', 'extract_wave_frames',
+        'extract_dancer_frames', 'collect_dancer_masks', 'key_outro_dancers',
+    ],
+)
+def interweave(processes=None, chunk_frames=150):
+    '''
+    Plan every frame, then render chunks of frames in parallel.
+    (processes=1 renders serially, with the same output.)
+    '''
+    prinnit('Interweaving fire, wave masking, randomizing...')
+    schedule = plan_interweave()
+    total_frames = len(schedule['source'])
+    make_frame_store('interweaved', total_frames)
+    frame_ranges = [
+        (start, min(start + chunk_frames, total_frames))
+        for start in range(0, total_frames, chunk_frames)
+    ]
+    mask_hits = mask_misses = 0
+    if processes == 1:
+        _, mask_hits, mask_misses = render_interweave_frames(schedule, (0, total_frames))
+    else:
+        pfunc = partial(render_interweave_frames, schedule)
+        # one thread per process, within the stage's budget
+        processes = processes or get_thread_budget()
+        with Pool(processes, cv2.setNumThreads, (1,)) as party, tqdm(total=total_frames) as pbar:
+            for num_frames, hits, misses in party.imap_unordered(pfunc, frame_ranges):
+                mask_hits += hits
+                mask_misses += misses
+                pbar.update(num_frames)
+    print(f'Dancer mask cache: {mask_hits} hits, {mask_misses} misses')
+
+
+@stage(
+    outputs=['media/glitch_input.avi'],
+    deps=['interweave'],
+    inputs=['media/dancers.mp4'],
+)
 def overlay():
-    if os.path.exists('media/glitch_input.avi'):
-        return
     prinnit('Adding dancer overlays and encoding frames for glitching...')
     # add group dances over the 1st/2nd chorus and bridge using lumakey
     # end on the curtain close
@@ -243,15 +244,19 @@ def overlay():
     overlay_cmds = ';\n        '.join(overlay_cmds)
     ffmpeg(f'''
       -i media/dancers.mp4
-      -framerate {fps} -i "media/frames/interweaved/%06d.png"
+      {get_frame_store('interweaved').ffmpeg_input(framerate=fps)}
       -filter_complex
        "[0:v] split={len(group_dancers_overlays)} {split_outputs};
         {overlay_cmds}"
       -map {last_overlay} -c:v libxvid -q:v 1 -g 1000 -qmin 1 -qmax 1 -flags qpel+mv4
-      media/glitch_input.avi
-    ''')
+    ''', 'media/glitch_input.avi')
 
 
+@stage(
+    outputs=['media/shadow14.mp4'],
+    deps=['extract_fire_frames', 'remove_iframes', 'overlay_dancers_on_mushroom_motion'],
+    inputs=['media/mushroom_timelapse.mp4', 'media/shadow.wav'],
+)
 def recombine():
     prinnit('Recombining glitched 2nd half, adding bridge fire, audio, and opening titles/credits...')
     metadata_description = f'''
@@ -260,8 +265,8 @@ def recombine():
     '''
     ffmpeg(f'''
       -i media/glitch_output.avi
-      -framerate {fps} -i "media/frames/fire_bridge/%06d.png"
-      -framerate {fps} -i "media/frames/outro_masked/%06d.png"
+      {get_frame_store('fire').ffmpeg_input(bridge_fire_start+1, framerate=fps)}
+      {get_frame_store('outro_masked').ffmpeg_input(framerate=fps)}
       -f lavfi -i "color=black:s=1280x720"
       -ss 00:02:19 -i media/mushroom_timelapse.mp4
       -i media/shadow.wav
@@ -277,7 +282,9 @@ def recombine():
           setpts=PTS-STARTPTS,
           lumakey=threshold=0:tolerance=0.1:softness=0.01
         [bridge_luma];
-        [1:v] eq=brightness='if(lt(n,{s_to_f(6*bar_dur)}), n/(r*{6*bar_dur})*0.5-0.5)':eval=frame [fire];
+        [1:v]
+          {get_fire_bridge_filter()},
+          eq=brightness='if(lt(n,{s_to_f(6*bar_dur)}), n/(r*{6*bar_dur})*0.5-0.5)':eval=frame [fire];
         [fire][bridge_luma] overlay=shortest=1 [bridge];
         {add_credits()};
         [opening_titles][prebridge][bridge][outro_credits] concat=n=4:v=1:a=0 [outv];
@@ -289,27 +296,30 @@ def recombine():
       -c:v libx264 -pix_fmt yuv420p -r {fps}
       -metadata title="Near Northeast - Shadow"
       -metadata description="{metadata_description}"
-      media/shadow14.mp4
-    ''')
+    ''', 'media/shadow14.mp4')
 
 
 def mkvid():
+    # every stage is declared with @stage,
+    # and only re-runs when its code, params, seed or inputs
+    # (or the stages it depends on) change.
+    # stages whose deps are done run in parallel, within the cores we have:
     # EXTRACT FRAMES
-    extract_fire_frames()
-    extract_wave_frames()
-    extract_dancer_frames()#align_test=True)
+    #   extract_fire_frames, extract_wave_frames, extract_dancer_frames
+    # COLLECT DANCER POSE MASKS,
+    # KEY OUTRO DANCERS OVER WAVES
+    #   collect_dancer_masks, key_outro_dancers
     # INTERWEAVE FIRE FRAMES,
     # FADE WAVES INTO DANCER,
     # RANDOMIZE DANCER MASKS
-    interweave()
+    #   interweave
     # OVERLAY GROUP DANCERS
-    overlay()
+    #   overlay
     # GLITCH BRIDGE AND OUTRO
-    remove_iframes()
-    add_mushroom_motion()
-    overlay_dancers_on_mushroom_motion()
+    #   remove_iframes, add_mushroom_motion, overlay_dancers_on_mushroom_motion
     # FINAL OUTPUT
-    recombine()
+    #   recombine
+    run_stages()
 
     # TODO: clean up
     # subprocess.run('rm -r media', check=True, shell=True)
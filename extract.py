@@ -1,123 +1,172 @@
-from glob import glob
+import json
 import os
-import shutil
-import subprocess
-from tqdm import tqdm, trange
+from tqdm import tqdm
 
+from blend import blend
+from multisubprocess import run_commands
 from params import *
 from segment import save_dancer_masks
+from stages import stage
 
 
+def get_dancer_cut_cmds(alignment_num, cut_params, start_number, num_shards=None, threads=None):
+    '''
+    The ffmpeg commands extracting one of the dancer_alignments,
+    numbering its frames from start_number:
+    one command, or `num_shards` for a minterpolated stretch.
+    '''
+    start_time, duration, stretch_duration_frames, *more_params = cut_params
+    more_params = more_params[0] if more_params else {}
+
+    if more_params.get('use_minterpolate') and not more_params.get('gradually') and 'lumakey' not in more_params:
+        stretch = stretch_duration_frames / fps / duration
+        return get_stretch_shard_cmds(
+            'media/dancers.mp4', start_time, stretch_duration_frames, get_frame_store('dancers'),
+            stretch, int(fps*stretch), start_number=start_number,
+            filters=dancers_crop_filter, num_shards=num_shards, threads=threads,
+        )
+
+    overlay = ''
+    if 'lumakey' in more_params:
+        lumakey_params = more_params['lumakey']
+        overlay = f'lumakey={lumakey_params} [overlay{alignment_num}]; [1:v][overlay{alignment_num}] overlay=shortest=1,'
+
+    stretch_cmd = get_stretch_cmd(
+        duration,
+        stretch_duration_frames,
+        **{ key: value for key, value in more_params.items() if key != 'lumakey' }
+    )
+
+    return [get_ffmpeg_cmd(f'''
+      -ss {start_time} -i media/dancers.mp4
+      -f lavfi -i "color=black:s=640x480:r=30"
+      -filter_complex
+       "{stretch_cmd}, fps={fps},
+        trim=end_frame={stretch_duration_frames},
+        {overlay} {dancers_crop_filter}"
+    ''', get_frame_store('dancers').ffmpeg_output(start_number), progress=True, threads=threads)]
+
+
+def check_frame_span(alignment_num, start_number, num_frames):
+    '''
+    Make sure an alignment wrote every frame it was supposed to.
+    '''
+    end_number = start_number + num_frames - 1
+    dancers = get_frame_store('dancers')
+    missing = [
+        frame_num for frame_num in range(start_number, end_number + 1)
+        if frame_num not in dancers
+    ]
+    if missing:
+        raise ValueError(
+            f'Dancer alignment {alignment_num} is missing {len(missing)} '
+            f'of its frames {start_number}-{end_number} (from frame {missing[0]})'
+        )
+
+
+@stage(
+    outputs=[get_frame_store_path('dancers')],
+    inputs=['media/dancers.mp4'],
+)
 def extract_dancer_frames(align_test=False):
-    if os.path.exists('media/frames/dancers'):
-        return
     prinnit('Extracting frames from the dancer video...')
-    subprocess.run('mkdir -p media/frames/dancers', check=True, shell=True)
+    dancers = make_frame_store('dancers')
 
+    # every alignment knows where its frames start,
+    # so they can all be extracted at once
+    # (and the slow minterpolated outro in shards)
+    budget = get_thread_budget() or os.cpu_count()
+    spans = []
+    jobs = []
     frame_count = 1
-    for i, cut_params in enumerate(tqdm(dancer_alignments)):
-        start_time, duration, stretch_duration_frames, *more_params = cut_params
-        more_params = more_params[0] if more_params else {}
-        if i < len(dancer_alignments)-1:
-            frame_count += stretch_duration_frames
-            continue
-
-        overlay = ''
-        if 'lumakey' in more_params:
-            lumakey_params = more_params['lumakey']
-            overlay = f'lumakey={lumakey_params} [overlay{i}]; [1:v][overlay{i}] overlay=shortest=1,'
-            del more_params['lumakey']
-
-        stretch_cmd = get_stretch_cmd(
-            duration,
-            stretch_duration_frames,
-            **more_params
-        )
+    for i, cut_params in enumerate(dancer_alignments):
+        spans.append((frame_count, cut_params[2]))
+        cmds = get_dancer_cut_cmds(i, cut_params, frame_count, num_shards=budget, threads=1)
+        jobs += [ [cmd] for cmd in cmds ]
+        frame_count += cut_params[2]
+    run_commands(jobs, max_concurrency=budget)
+    for i, (start_number, num_frames) in enumerate(spans):
+        check_frame_span(i, start_number, num_frames)
 
+    if align_test:
+        prinnit('Making align test...')
         ffmpeg(f'''
-          -ss {start_time} -i media/dancers.mp4
-          -f lavfi -i "color=black:s=640x480:r=30"
-          -filter_complex
-           "{stretch_cmd}, fps={fps},
-            trim=end_frame={stretch_duration_frames},
-            {overlay} {dancers_crop_filter}"
-          -start_number {frame_count} "media/frames/dancers/%06d.png"
-        ''')
-        frame_count += stretch_duration_frames
-        actual_frame_count = len(glob('media/frames/dancers/*.png'))
-        assert actual_frame_count == frame_count-1
-
-    # COLLECT DANCER POSE MASKS
-    # do this before luma because pose segmentation
-    # works better on original images
+          {dancers.ffmpeg_input(framerate=fps)}
+          -i media/shadow.wav
+          -map 0:v -map 1:a -shortest
+          -c:v libx264 -pix_fmt yuv420p -y
+        ''', 'media/align_test.mp4')
+
+
+# its own stage, since which masks interweave needs depends on its timing params,
+# and tweaking those shouldn't re-extract the dancers
+@stage(
+    outputs=[mask_store_path, mask_index_path],
+    deps=['extract_dancer_frames'],
+)
+def collect_dancer_masks():
+    # from the dancer frames as they were extracted,
+    # because pose segmentation works better on original images
     save_dancer_masks()
 
-    prinnit('Applying lumakey to outro dancers...')
-    ffmpeg(f'''
-      -start_number {s_to_f(outro_start)+1} -i "media/frames/dancers/%06d.png"
-      -vf "lumakey=threshold=0:tolerance=0.15:softness=0.1"
-      -start_number {s_to_f(outro_start)+1} "media/frames/dancers/%06d.png"
-    ''')
 
-    # for the outro, overlay the man/woman mirror dancers on top of slow waves
-    # (to provide new colors to glitch, since it goes totally pink without new iframes...)
+@stage(
+    outputs=[get_frame_store_path('outro_dancers')],
+    deps=['extract_dancer_frames', 'collect_dancer_masks', 'extract_wave_frames'],
+)
+def key_outro_dancers():
+    '''
+    For the outro, lumakey the dancers
+    and overlay the man/woman mirror dancers on top of slow waves
+    (to provide new colors to glitch, since it goes totally pink without new iframes...)
+    The keyed frames keep the dancer frame numbers.
+    '''
     # 2 beats of waves every 4 bars
     # but the last 8 bars are left to glitch fully pink
     wave_frames = s_to_f(beat_dur*2)
     waves_freq = bar_dur*4
     num_waves = 4
+    # which waves_slow frame goes under each dancer frame,
+    # instead of buffering the loop in ffmpeg
+    wave_frame_nums = {
+        s_to_f(outro_start + waves_freq*(wave_num+1)) + 1 + i : i + 1
+        for wave_num in range(num_waves)
+        for i in range(wave_frames)
+    }
 
-    prinnit('Adding waves to outro...')
-    pbar = tqdm(total=num_waves*wave_frames)
-    for wave_num in range(num_waves):
-        waves_start_frame = s_to_f(outro_start + waves_freq*(wave_num+1)) + 1
-        # prevent waves coming thru transparent bodies
-        for i in range(wave_frames):
-            frame_num = waves_start_frame + i
-            in_path = f'media/frames/dancers/{frame_num:06d}.png'
-            out_path = in_path
-            dancers = cv2.imread(in_path, cv2.IMREAD_UNCHANGED)
-            # apply the luma's alpha channel so the color doesn't jump
-            luma_mask = dancers[:,:,3] / 255
-            dancers = dancers * np.stack((luma_mask,)*4, axis=-1)
-            # then use the pose segmentation mask as a new alpha
-            pose_mask = get_mask(f'media/frames/dancers_mask/{frame_num:06d}.npy', as_alpha=True)
-            dancers[:,:,3] = pose_mask
-            cv2.imwrite(out_path, dancers)
-            pbar.update()
-    loop_frames = s_to_f(waves_freq)
-    ffmpeg(f'''
-      -i "media/frames/waves_slow/%06d.png"
-      -start_number {s_to_f(outro_start)+1} -i "media/frames/dancers/%06d.png"
-      -f lavfi -i "color=black:s={cropx}"
-      -filter_complex
-       "[0:v]
-          trim=end_frame={wave_frames},
-          tpad=stop={loop_frames-wave_frames+1},
-          loop=loop={num_waves-1}:size={loop_frames+1},
-          tpad=start={loop_frames}:stop=-1
-        [waves];
-        [waves][1:v] overlay=shortest=1 [waves_overlay]"
-      -map [waves_overlay] -start_number {s_to_f(outro_start)+1} "media/frames/dancers/%06d.png"
-    ''')
-
-    if align_test:
-        prinnit('Making align test...')
-        ffmpeg(f'''
-          -framerate {fps} -i "media/frames/dancers/%06d.png"
-          -i media/shadow.wav
-          -map 0:v -map 1:a -shortest
-          -c:v libx264 -pix_fmt yuv420p
-          -y media/align_test.mp4
-        ''')
+    prinnit('Keying outro dancers over waves...')
+    dancers = get_frame_store('dancers')
+    outro_dancers = make_frame_store('outro_dancers')
+    waves_slow = get_frame_store('waves_slow')
+    outro_start_frame = s_to_f(outro_start) + 1
+    outro_frames = ffmpeg_frames(
+        dancers.ffmpeg_input(outro_start_frame),
+        'lumakey=threshold=0:tolerance=0.15:softness=0.1', pix_fmt='bgra',
+    )
+    with frame_sink(outro_dancers.ffmpeg_output(outro_start_frame)) as write:
+        for frame_num, dancer in enumerate(
+            tqdm(outro_frames, total=get_num_dancer_frames() + 1 - outro_start_frame), outro_start_frame
+        ):
+            # apply the luma's alpha channel, over black
+            out = blend(dancer[:,:,3], dancer[:,:,:3], 0)
+            if frame_num in wave_frame_nums:
+                waves = waves_slow[wave_frame_nums[frame_num]]
+                # then use the pose segmentation mask as a new alpha over the waves,
+                # to prevent waves coming thru transparent bodies
+                blend(get_mask(frame_num, as_alpha=True), out, waves, out=out)
+            write(out)
 
 
+@stage(
+    outputs=[get_frame_store_path('fire'), get_frame_store_path('fire_trail'), fire_bridge_path],
+    inputs=['media/fire.mp4'],
+    seed=0,
+    # one ffmpeg at a time, mostly decoding and writing pngs
+    threads=2,
+)
 def extract_fire_frames():
-    if os.path.exists('media/frames/fire'):
-        return
-
     prinnit('Extracting frames from the fire video...')
-    subprocess.run('mkdir -p media/frames/fire', check=True, shell=True)
+    fire = make_frame_store('fire')
     # on the 2nd verse,
     # the fire flashes brightly with the guitar crashes
     # and dims as they fade
@@ -125,22 +174,18 @@ def extract_fire_frames():
     ffmpeg(f'''
       -i media/fire.mp4
       -vf "trim=duration={total_dur}, {crop_filter}, fps={fps}"
-      "media/frames/fire/%06d.png"
-    ''')
+    ''', fire.ffmpeg_output())
 
     prinnit('Flashing and fading the fire brightness for verse 2...')
-    subprocess.run('mkdir -p media/frames/fire_trail', check=True, shell=True)
+    fire_trail = make_frame_store('fire_trail')
     ffmpeg(f'''
-      -framerate {fps} -start_number {fire_trail_start+1} -i "media/frames/fire/%06d.png"
+      {fire.ffmpeg_input(fire_trail_start+1, framerate=fps)}
       -vf
         "trim=end_frame={fire_trail_dur},
          eq=brightness='0.5 - 0.75*mod(n,{fade}*r)/({fade}*r)':eval=frame"
-      -start_number {fire_trail_start+1} "media/frames/fire_trail/%06d.png"
-    ''')
+    ''', fire_trail.ffmpeg_output(fire_trail_start+1))
 
     prinnit('Making random fire flickers for bridge...')
-    subprocess.run('mkdir -p media/frames/fire_bridge', check=True, shell=True)
-    black_frame = np.zeros((720, 1280, 3), dtype='uint8')
     # ramp up to when song drops off
     fire_frames_up_slow = s_to_f(5*bar_dur)
     fire_frames_up_fast = s_to_f(1*bar_dur)
@@ -150,28 +195,48 @@ def extract_fire_frames():
         np.random.random(fire_frames_up_fast) < np.linspace(0.1, 0.5, num=fire_frames_up_fast),
         np.full(no_fire_frames, False)
     ))
-    for i in trange(len(is_fire)):
-        frame_num = i + bridge_fire_start + 1
-        in_path = f'media/frames/fire/{frame_num:06d}.png'
-        out_path = f'media/frames/fire_bridge/{i+1:06d}.png'
-        if is_fire[i]:
-            shutil.copyfile(inpath, outpath)
-        else:
-            cv2.imwrite(out_path, black_frame)
+    # recombine blacks out the rest of the fire frames as it goes (see get_fire_bridge_filter)
+    with open(fire_bridge_path, 'w') as f:
+        json.dump({
+            'num_frames'  : len(is_fire),
+            'fire_frames' : np.flatnonzero(is_fire).tolist(),
+        }, f)
+
+
+def get_fire_bridge_filter():
+    '''
+    The ffmpeg filter making the bridge fire flicker out of the fire frames
+    (starting at the bridge): only the frames extract_fire_frames picked show fire,
+    the rest are black.
+    '''
+    with open(fire_bridge_path) as f:
+        fire_bridge = json.load(f)
+    # runs of consecutive fire frames
+    fire_frames = np.array(fire_bridge['fire_frames'], dtype=int)
+    breaks = np.flatnonzero(np.diff(fire_frames) != 1) + 1
+    runs = [ (run[0], run[-1]) for run in np.split(fire_frames, breaks) if len(run) ]
+    is_fire = '+'.join(f'between(n,{first},{last})' for first, last in runs) or '0'
+    blackout = f"drawbox=x=0:y=0:w=iw:h=ih:color=black:t=fill:enable='not({is_fire})'"
+    return f"trim=end_frame={fire_bridge['num_frames']}, {blackout}"
 
 
+@stage(
+    outputs=[get_frame_store_path('waves'), get_frame_store_path('waves_slow')],
+    inputs=['media/waves.mp4'],
+    # the slow waves are interpolated in parallel shards,
+    # on all but the cores the fire extraction uses beside it
+    threads=max(os.cpu_count() - 2, 1),
+)
 def extract_wave_frames():
     for is_slow in (False, True):
-        postfix = '_slow' if is_slow else ''
-        filepath = f'media/frames/waves{postfix}'
-        if os.path.exists(filepath):
-            continue
-        prinnit(f'Extracting frames from the waves video to {filepath}...')
-        subprocess.run(f'mkdir -p {filepath}', check=True, shell=True)
+        name = 'waves_slow' if is_slow else 'waves'
+        prinnit(f'Extracting frames from the waves video to {get_frame_store_path(name)}...')
+        waves = make_frame_store(name)
 
-        waves_input = '-ss 144.5 -i media/waves.mp4'
-        trim_cmd = 'duration=17,'
-        waves_output = f'"{filepath}/%06d.png"'
+        waves_start = 144.5
+        waves_duration = 17
+        waves_input = f'-ss {waves_start} -i media/waves.mp4'
+        trim_cmd = f'trim=duration={waves_duration},'
 
         if is_slow:
             # slow down the video before cropping
@@ -181,30 +246,28 @@ def extract_wave_frames():
             slow_down1_frames = fade2_end_frame - fade2_start_frame
             slow_down2_duration = synth_arp_start - fade2_end
             slow_down2_frames = s_to_f(synth_arp_start) - fade2_end_frame
-            ffmpeg(f'''
-              {waves_input}
-              -filter_complex
-                "[0:v]
-                   {trim_cmd} minterpolate=mi_mode=mci:fps={fps*slow_down}, split=2
-                 [waves1][waves2];
-                 [waves1]
-                   setpts='((T/{slow_down1_duration}*{slow_down-1})+1)*PTS',
-                   fps={fps}, trim=start_frame=0:end_frame={slow_down1_frames}
-                 [waves_slow1];
-                 [waves2]
-                   setpts='((T/{slow_down2_duration}*{slow_down-1})+1)*PTS',
-                   fps={fps}, trim=start_frame=0:end_frame={slow_down2_frames}
-                 [waves_slow2];
-                 [waves_slow1][waves_slow2]
-                   concat=n=2:v=1:a=0
-                 [outv]"
-              -map [outv] {waves_output}
-            ''')
-            waves_input = f'-framerate {fps} -i {waves_output}'
+            # both slow downs start from the beginning of the waves,
+            # slowing down gradually, one after the other
+            budget = get_thread_budget() or os.cpu_count()
+            jobs = []
+            start_number = 1
+            for duration, num_frames in (
+                (slow_down1_duration, slow_down1_frames),
+                (slow_down2_duration, slow_down2_frames),
+            ):
+                cmds = get_stretch_shard_cmds(
+                    'media/waves.mp4', waves_start, num_frames, waves,
+                    slow_down, fps*slow_down, gradually=True, curve_duration=duration,
+                    start_number=start_number, end_time=waves_duration,
+                    num_shards=budget, threads=1,
+                )
+                jobs += [ [cmd] for cmd in cmds ]
+                start_number += num_frames
+            run_commands(jobs, max_concurrency=budget)
+            waves_input = waves.ffmpeg_input(framerate=fps)
             trim_cmd = ''
 
         ffmpeg(f'''
           {waves_input}
           -vf "{trim_cmd} crop=480:352:80:4, {crop_filter}, fps={fps}"
-          {waves_output}
-        ''')
+        ''', waves.ffmpeg_output())
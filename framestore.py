@@ -0,0 +1,279 @@
+from abc import ABC, abstractmethod
+from glob import glob
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+
+# how opencv reads frames with this many channels
+imread_flags = {
+    1 : cv2.IMREAD_GRAYSCALE,
+    3 : cv2.IMREAD_COLOR,
+    4 : cv2.IMREAD_UNCHANGED,
+}
+# and the rawvideo pixel formats they are
+raw_pix_fmts = {
+    1 : 'gray',
+    3 : 'bgr24',
+    4 : 'bgra',
+}
+
+class FrameStore(ABC):
+    '''
+    The frames of one intermediate, numbered from 1 like ffmpeg's %06d sequences.
+    store[frame_num] reads a frame (a new uint8 array) and store[frame_num] = frame writes one,
+    store[start:stop] reads a run of frames (by frame number) as one array,
+    and len(store) is how many frames it has.
+    `shape` is the shape of a frame (or None for BGR frames of any size).
+    '''
+    def __init__(self, shape):
+        self.shape = None if shape is None else tuple(shape)
+        self.channels = 3
+        if self.shape is not None:
+            self.channels = self.shape[2] if len(self.shape) > 2 else 1
+
+    @abstractmethod
+    def read(self, frame_num):
+        pass
+
+    @abstractmethod
+    def write(self, frame_num, frame):
+        pass
+
+    @abstractmethod
+    def create(self, num_frames=None):
+        '''
+        Get ready to write up to `num_frames` new frames.
+        '''
+
+    @abstractmethod
+    def ffmpeg_input(self, start_number=1, framerate=None):
+        '''
+        ffmpeg input args reading the frames from `start_number` on.
+        '''
+
+    @abstractmethod
+    def ffmpeg_output(self, start_number=1):
+        '''
+        ffmpeg output args writing frames numbered from `start_number`.
+        '''
+
+    def copy(self, other, frame_num):
+        '''
+        Copy a frame from another store.
+        '''
+        self.write(frame_num, other.read(frame_num))
+
+    @abstractmethod
+    def __len__(self):
+        pass
+
+    @abstractmethod
+    def __contains__(self, frame_num):
+        pass
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            return self.read(key)
+        start = 1 if key.start is None else key.start
+        stop = len(self) + 1 if key.stop is None else key.stop
+        frames = [ self.read(frame_num) for frame_num in range(start, stop, key.step or 1) ]
+        if not frames:
+            return np.empty((0, *(self.shape or ())), dtype='uint8')
+        return np.stack(frames)
+
+    def __setitem__(self, frame_num, frame):
+        self.write(frame_num, frame)
+
+
+class FileFrameStore(FrameStore):
+    '''
+    Frames kept as an image file each in `dir`,
+    which ffmpeg can read and write as an image sequence.
+    '''
+    extension = None
+
+    def __init__(self, dir, shape):
+        super().__init__(shape)
+        self.dir = dir
+        self.pattern = os.path.join(dir, f'%06d.{self.extension}')
+
+    def get_path(self, frame_num):
+        return self.pattern % frame_num
+
+    def get_codec_args(self):
+        return ''
+
+    def create(self, num_frames=None):
+        os.makedirs(self.dir, exist_ok=True)
+
+    def ffmpeg_input(self, start_number=1, framerate=None):
+        framerate = f'-framerate {framerate} ' if framerate else ''
+        return f'{framerate}-start_number {start_number} -i "{self.pattern}"'
+
+    def ffmpeg_output(self, start_number=1):
+        return f'{self.get_codec_args()}-start_number {start_number} "{self.pattern}"'
+
+    def copy(self, other, frame_num):
+        # the same format, so there's nothing to decode
+        if type(other) is type(self):
+            shutil.copyfile(other.get_path(frame_num), self.get_path(frame_num))
+        else:
+            super().copy(other, frame_num)
+
+    def __len__(self):
+        return len(glob(os.path.join(self.dir, f'*.{self.extension}')))
+
+    def __contains__(self, frame_num):
+        return os.path.exists(self.get_path(frame_num))
+
+
+class PngFrameStore(FileFrameStore):
+    '''
+    PNG frames, zlib compressed at `compression` (0 is fastest, 9 is smallest).
+    '''
+    extension = 'png'
+
+    def __init__(self, dir, shape, compression=1):
+        super().__init__(dir, shape)
+        self.compression = compression
+
+    def get_codec_args(self):
+        return f'-compression_level {self.compression} '
+
+    def read(self, frame_num):
+        path = self.get_path(frame_num)
+        frame = cv2.imread(path, imread_flags[self.channels])
+        if frame is None:
+            raise ValueError(f'Could not read frame {path}')
+        return frame
+
+    def write(self, frame_num, frame):
+        cv2.imwrite(self.get_path(frame_num), frame, [cv2.IMWRITE_PNG_COMPRESSION, self.compression])
+
+
+class QoiFrameStore(FileFrameStore):
+    '''
+    QOI frames: lossless like PNG, but much faster to encode and decode
+    (a bit bigger than low-compression PNG).
+    Needs the qoi package, ffmpeg reads and writes them itself.
+    '''
+    extension = 'qoi'
+
+    def read(self, frame_num):
+        import qoi
+        # qoi is RGB(A), we're BGR(A)
+        rgb = qoi.read(self.get_path(frame_num))
+        return np.ascontiguousarray(rgb[..., [2, 1, 0, 3][:self.channels]])
+
+    def write(self, frame_num, frame):
+        import qoi
+        qoi.write(self.get_path(frame_num), np.ascontiguousarray(frame[..., [2, 1, 0, 3][:frame.shape[-1]]]))
+
+
+class RawFrameStore(FrameStore):
+    '''
+    Frames kept uncompressed in one preallocated .npy volume at `path`,
+    so reading or writing one is just a copy.
+    ffmpeg can read it as rawvideo, but it can't write into it,
+    so it's only for frames written from python.
+    '''
+    def __init__(self, path, shape):
+        super().__init__(shape)
+        self.path = path
+        self.volume = None
+
+    def get_volume(self):
+        if self.volume is None:
+            self.volume = np.load(self.path, mmap_mode='r+')
+        return self.volume
+
+    def create(self, num_frames=None):
+        if num_frames is None:
+            raise ValueError(f'A raw frame volume needs to know how many frames to make room for ({self.path})')
+        self.volume = np.lib.format.open_memmap(
+            self.path, mode='w+', dtype='uint8', shape=(num_frames, *self.shape)
+        )
+
+    def read(self, frame_num):
+        return np.array(self.get_volume()[frame_num-1])
+
+    def write(self, frame_num, frame):
+        self.get_volume()[frame_num-1] = frame
+
+    def ffmpeg_input(self, start_number=1, framerate=None):
+        volume = self.get_volume()
+        height, width = self.shape[:2]
+        framerate = f'-framerate {framerate} ' if framerate else ''
+        # skip the .npy header and the frames before start_number
+        offset = volume.offset + (start_number-1) * volume[0].nbytes
+        return f'''-f rawvideo -pixel_format {raw_pix_fmts[self.channels]} -video_size {width}x{height}
+          {framerate}-skip_initial_bytes {offset} -i "{self.path}"'''
+
+    def ffmpeg_output(self, start_number=1):
+        raise ValueError(f"ffmpeg can't write into a raw frame volume ({self.path}), use png or qoi frames")
+
+    def __len__(self):
+        return len(self.get_volume())
+
+    def __contains__(self, frame_num):
+        return 1 <= frame_num <= len(self)
+
+
+def get_store_size(store):
+    if isinstance(store, RawFrameStore):
+        return os.path.getsize(store.path)
+    return sum(map(os.path.getsize, glob(os.path.join(store.dir, f'*.{store.extension}'))))
+
+
+def benchmark(frames_dir='media/frames/dancers', num_frames=100):
+    '''
+    Time writing and reading the first `num_frames` of a PNG sequence with each backend,
+    and show how big they are.
+    (The reads come right after the writes, so this is mostly encoding/decoding, not the disk.)
+    '''
+    source = PngFrameStore(frames_dir, None)
+    num_frames = min(num_frames, len(source))
+    if not num_frames:
+        print(f'No frames in {frames_dir}')
+        return
+    frames = source[1:num_frames+1]
+    shape = frames.shape[1:]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        stores = {
+            'raw'   : RawFrameStore(os.path.join(tmp_dir, 'raw.npy'), shape),
+            **{
+                f'png{compression}' : PngFrameStore(os.path.join(tmp_dir, f'png{compression}'), shape, compression)
+                for compression in (0, 1, 3, 9)
+            },
+            'qoi'   : QoiFrameStore(os.path.join(tmp_dir, 'qoi'), shape),
+        }
+        for name, store in stores.items():
+            store.create(num_frames)
+            start = time.perf_counter()
+            try:
+                for frame_num, frame in enumerate(frames, 1):
+                    store[frame_num] = frame
+            except ImportError as error:
+                print(f'{name}: skipped ({error})')
+                continue
+            write_time = time.perf_counter() - start
+            start = time.perf_counter()
+            read = store[1:num_frames+1]
+            read_time = time.perf_counter() - start
+            print(
+                f'{name}: write {write_time / num_frames * 1000:.1f}ms/frame, '
+                f'read {read_time / num_frames * 1000:.1f}ms/frame, '
+                f'{get_store_size(store) / num_frames / 2**20:.2f}MB/frame'
+                f'{"" if np.array_equal(read, frames) else " (NOT LOSSLESS)"}'
+            )
+
+
+if __name__ == '__main__':
+    # python framestore.py [frames dir] [number of frames]
+    benchmark(*sys.argv[1:2], *map(int, sys.argv[2:3]))
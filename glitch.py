@@ -1,48 +1,123 @@
 from functools import partial
+import hashlib
 import json
 from multiprocessing import Pool
 import os
-import shutil
-import subprocess
 
 from tqdm import tqdm
 
-from multisubprocess import subprocess_pool
+from avi import index_avi, write_avi
+from blend import blend, scale, to_alpha
+from multisubprocess import run_commands
 from params import *
+from stages import hash_code, hash_input, hash_value, remove_outputs, stage
+from vectors import (
+    get_vector_strings, has_cached_vectors, load_cached_vectors, read_ffedit_vectors, resample_vectors, save_cached_vectors
+)
+
+
+# the datamosh, as operations applied in order to the overlay's frames
+# (frame numbers refer to the frames as the previous operations left them):
+#   drop_iframes - replace iframes in [start, end) with the frame before
+#   bloom        - duplicate `frame` `count` more times
+#   repeat       - play [start, end) `count` more times
+#   splice       - insert frames [start, end) of the AVI at `path` before `at`
+glitch_operations = [
+    # remove iframes until the end
+    { 'op': 'drop_iframes', 'start': glitch_start_frame },
+]
+
+def get_frame_types(sources, plan):
+    types = np.empty(len(plan), dtype='S1')
+    for source_num, source in enumerate(sources):
+        is_source = plan[:, 0] == source_num
+        types[is_source] = source['frames']['type'][plan[is_source, 1]]
+    return types
+
+
+def check_frame_range(num_frames, start, end):
+    if not 0 <= start < end <= num_frames:
+        raise ValueError(f'Frames [{start}, {end}) are out of range (0-{num_frames})')
+
+
+def drop_iframes(plan, sources, start=0, end=None):
+    end = len(plan) if end is None else end
+    check_frame_range(len(plan), start, end)
+    iframes = np.flatnonzero(get_frame_types(sources, plan)[start:end] == b'I') + start
+    # there's nothing before the first frame
+    iframes = iframes[iframes > 0]
+    for index in iframes:
+        # use the last frame to keep song alignment
+        plan[index] = plan[index-1]
+    print(f'Removed {len(iframes)} iframes')
+    return plan
+
+
+def bloom_frame(plan, sources, frame, count):
+    check_frame_range(len(plan), frame, frame+1)
+    bloom = np.repeat(plan[frame:frame+1], count, axis=0)
+    return np.concatenate([plan[:frame+1], bloom, plan[frame+1:]])
+
 
+def repeat_frames(plan, sources, start, end, count=1):
+    check_frame_range(len(plan), start, end)
+    return np.concatenate([plan[:end], *[plan[start:end]]*count, plan[end:]])
 
-# 0x30306463 signals the end of a frame.
-frame_header = bytes.fromhex('30306463')
-# 0x0001B0 signals the beginning of an iframe
-iframe = bytes.fromhex('0001B0')
-# 0x0001B6 signals a pframe
-pframe = bytes.fromhex('0001B6')
 
+def splice_frames(plan, sources, source_num, start, end, at):
+    check_frame_range(len(sources[source_num]['frames']), start, end)
+    check_frame_range(len(plan)+1, at, at+1)
+    spliced = np.column_stack([np.full(end-start, source_num), np.arange(start, end)])
+    return np.concatenate([plan[:at], spliced, plan[at:]])
+
+
+def datamosh(in_path, out_path, operations):
+    '''
+    Apply datamosh operations (see glitch_operations) to the frames of an AVI,
+    then write the result in a single streaming pass.
+    Spliced AVIs need the same codec and resolution as the input.
+    '''
+    sources = [index_avi(in_path)]
+    source_nums = {in_path: 0}
+    num_frames = len(sources[0]['frames'])
+    # (source number, frame number) of each output frame
+    plan = np.column_stack([np.zeros(num_frames, dtype=int), np.arange(num_frames)])
+    for operation in operations:
+        args = dict(operation)
+        op = args.pop('op')
+        if 'path' in args:
+            path = args.pop('path')
+            if path not in source_nums:
+                source_nums[path] = len(sources)
+                sources.append(index_avi(path))
+            args['source_num'] = source_nums[path]
+        if op == 'drop_iframes':
+            plan = drop_iframes(plan, sources, **args)
+        elif op == 'bloom':
+            plan = bloom_frame(plan, sources, **args)
+        elif op == 'repeat':
+            plan = repeat_frames(plan, sources, **args)
+        elif op == 'splice':
+            plan = splice_frames(plan, sources, **args)
+        else:
+            raise ValueError(f'Unknown datamosh operation: {op}')
+    write_avi(out_path, sources, plan)
+    return plan
+
+
+@stage(
+    outputs=['media/glitch_output.avi'],
+    deps=['overlay'],
+)
 def remove_iframes():
-    if os.path.exists('media/glitch_output.avi'):
-        return
     prinnit(f'Removing iframes after {glitch_start_frame+1}...')
-    with open('media/glitch_input.avi', 'rb') as in_file:
-        frames = in_file.read().split(frame_header)
-    removed_iframes = []
-    with open('media/glitch_output.avi', 'wb') as out_file:
-        # write header
-        out_file.write(frames.pop(0))
-        for index, frame in enumerate(frames):
-            # remove iframes until the end
-            if index >= glitch_start_frame:
-                frame_type = frame[5:8]
-                if frame_type == iframe:
-                    removed_iframes.append(index)
-                    # use the last frame to keep song alignment
-                    frame = last_frame
-            # add back the frame separator token
-            out_file.write(frame_header + frame)
-            last_frame = frame
-    print(f'Removed {len(removed_iframes)} iframes')
+    datamosh('media/glitch_input.avi', 'media/glitch_output.avi', glitch_operations)
 
 # this is the original size of the mushroom timelapse
 motion_scale = '1920:1080'
+# the outro gets the motion at its own size
+# (the vectors are resampled to fit; shrink it for quicker previews)
+outro_motion_scale = crop
 # we need 12 clips for the outro
 # ( start, duration )
 mushroom_chunks = [
@@ -67,186 +142,228 @@ mushroom_chunks = [
 ]
 num_chunks = len(mushroom_chunks)
 
-def cut_outro():
+def get_outro_cut_cmd(chunk_num, threads=None):
     chunk_dur = 4*bar_dur
-    for chunk_num in range(num_chunks):
-        out_path = f'media/outro_cut{chunk_num}.mp4'
-        if os.path.exists(out_path):
-            continue
-        # first four chunks are half of the riff duration
-        # (to keep the motion transfer from turning everything pink)
-        chunk_start = outro_start + chunk_dur*chunk_num
-        if chunk_num < num_chunks-1:
-            cmd = f'trim=duration={chunk_dur}, '
-        else:
-            # but last chunk is the rest of the song
-            cmd = ''
-        cmd += f'scale={motion_scale}'
-        ffmpeg(f'''
-          -ss {chunk_start} -i media/glitch_output.avi
-          -vf "{cmd}" -an
-          media/outro_cut{chunk_num}.mp4
-        ''')
-
-
-def cut_mushroom_timelapse(chunk_num, mushroom_alignments, send_pipe):
-    mushroom_cut_path = f'media/mushroom_cut{chunk_num}.mp4'
-    if os.path.exists(mushroom_cut_path):
-        return
+    # first four chunks are half of the riff duration
+    # (to keep the motion transfer from turning everything pink)
+    chunk_start = outro_start + chunk_dur*chunk_num
+    if chunk_num < num_chunks-1:
+        cmd = f'trim=duration={chunk_dur}, '
+    else:
+        # but last chunk is the rest of the song
+        cmd = ''
+    cmd += f'scale={outro_motion_scale}'
+    return get_ffmpeg_cmd(f'''
+      -ss {chunk_start} -i media/glitch_output.avi
+      -vf "{cmd}" -an
+    ''', f'media/outro_cut{chunk_num}.mp4', progress=True, threads=threads)
+
+
+def get_mushroom_temp_paths(clip_num):
+    '''
+    The files a mushroom clip goes thru on the way to its vectors:
+    the cut clip, its mpeg2 re-encode, and the vectors ffedit exports from it.
+    '''
+    return f'media/mushroom_cut{clip_num}.mp4', f'tmp_mushroom{clip_num}.mpg', f'tmp{clip_num}.json'
+
+
+def get_mushroom_cut_cmd(clip_num, alignment, threads=None):
+    '''
+    Cut one of the mushroom timelapse clips, stretched to 2 bars.
+    '''
+    mushroom_cut_path, _, _ = get_mushroom_temp_paths(clip_num)
+    start_time, duration = alignment
 
     # each clip is 2 bars
     target_duration = bar_dur*2
-    align_cmds = []
-    split_outputs = []
-    concat_inputs = []
-    for i, (start_time, duration) in enumerate(mushroom_alignments):
-        align_input = f'[mushrooms{i}]'
-        align_output = f'[aligned{i}]'
-        is_slower = target_duration > duration
-        stretch_cmd = get_stretch_cmd(
-            duration,
-            s_to_f(target_duration),
-            use_minterpolate=is_slower
-        )
-        # if it's sped up, we should use minterpolate after to get from 25 to 30 fps
-        fps_cmd = f'fps={fps}' if is_slower else f'minterpolate=fps={fps}:mi_mode=mci'
-        cmd = f'''{align_input}
-            trim=start={start_time}:duration={duration},
-            {stretch_cmd},
-            {fps_cmd},
-            trim=end_frame={s_to_f(target_duration)}
-        {align_output}'''
-        align_cmds.append(cmd)
-        split_outputs.append(align_input)
-        concat_inputs.append(align_output)
+    is_slower = target_duration > duration
+    stretch_cmd = get_stretch_cmd(
+        duration,
+        s_to_f(target_duration),
+        use_minterpolate=is_slower
+    )
+    # if it's sped up, we should use minterpolate after to get from 25 to 30 fps
+    fps_cmd = f'fps={fps}' if is_slower else f'minterpolate=fps={fps}:mi_mode=mci'
 
     # also crop out the labels/logo and rescale,
     # they cause distracting blocks in the glitch
-    split_outputs = ''.join(split_outputs)
-    align_cmds = ';\n        '.join(align_cmds)
-    concat_inputs = ''.join(concat_inputs)
-    ffmpeg(f'''
+    return get_ffmpeg_cmd(f'''
       -i media/mushroom_timelapse.mp4
-      -filter_complex
-       "[0:v] split={len(mushroom_alignments)} {split_outputs};
-        {align_cmds};
-        {concat_inputs} concat=n={len(mushroom_alignments)}:v=1:a=0 [cut];
-        [cut]
-          crop=h=915:y=50,
-          scale={motion_scale}:force_original_aspect_ratio=increase,
-          crop={motion_scale}, setsar=1
-        [cutcrop]"
-      -map [cutcrop] -an {mushroom_cut_path}
-    ''', output_pipe=send_pipe)
+      -vf
+       "trim=start={start_time}:duration={duration},
+        {stretch_cmd},
+        {fps_cmd},
+        trim=end_frame={s_to_f(target_duration)},
+        crop=h=915:y=50,
+        scale={motion_scale}:force_original_aspect_ratio=increase,
+        crop={motion_scale}, setsar=1"
+      -an -y
+    ''', mushroom_cut_path, progress=True, threads=threads)
 
 # code for motion vector transfer modified from:
 # https://github.com/tiberiuiancu/datamoshing
 
-def get_motion_vectors(chunk_num, input_video, send_pipe):
-    # extract video data using ffedit
-    motion_vid = f'tmp{chunk_num}.mpg'
-    ffgac(f'''
+def get_mpeg2_cmd(input_video, motion_vid, iframe_interval, threads=None):
+    '''
+    Re-encode a video in a way that ffedit can read/write its motion vectors.
+    '''
+    return get_ffmpeg_cmd(f'''
       -i {input_video} -an
-      -mpv_flags +nopimb+forcemv -qscale:v 0 -g 1000
+      -mpv_flags +nopimb+forcemv -qscale:v 0 -g {iframe_interval}
       -vcodec mpeg2video -f rawvideo -y
-      {motion_vid}
-    ''', output_pipe=send_pipe)
-    motion_json = f'tmp{chunk_num}.json'
-    ffedit(f'-i {motion_vid} -f mv:0 -e {motion_json}', output_pipe=send_pipe)
-    os.remove(motion_vid)
+    ''', motion_vid, alt_binary='ffgac', progress=True, threads=threads)
+
 
+def get_mushroom_vector_cmds(clip_num, alignment, threads=None):
+    '''
+    Cut a mushroom timelapse clip
+    and export its motion vectors (see read_mushroom_vectors).
+    '''
+    mushroom_cut_path, motion_vid, motion_json = get_mushroom_temp_paths(clip_num)
+    return [
+        get_mushroom_cut_cmd(clip_num, alignment, threads),
+        get_mpeg2_cmd(mushroom_cut_path, motion_vid, 1000, threads),
+        get_ffmpeg_cmd(f'-i {motion_vid} -f mv:0 -e {motion_json}', alt_binary='ffedit'),
+    ]
+
+
+def read_mushroom_vectors(clip_num):
     # from the data we extracted,
-    # grab the motion vector in each frame
-    with open(motion_json, 'r') as f:
-        raw_data = json.load(f)
-    os.remove(motion_json)
-    frames = raw_data['streams'][0]['frames']
-    vectors = []
-    for frame in frames:
-        try:
-            vectors.append(frame['mv']['forward'])
-        except:
-            vectors.append([])
-    return vectors
-
-
-def transfer_motion_vectors(chunk_num, send_pipe, method='add', iframe_interval=10000):
-    output_video = f'media/outro_mushroom_motion{chunk_num}.mpg'
-    if os.path.exists(output_video):
-        return
-    vector_video = f'media/mushroom_cut{chunk_num}.mp4'
-    input_video = f'media/outro_cut{chunk_num}.mp4'
-    vectors = get_motion_vectors(chunk_num, vector_video, send_pipe)
-    motion_vid = f'tmp{chunk_num}.mpg'
-    ffgac(f'''
-      -i {input_video}
-      -an -mpv_flags +nopimb+forcemv -qscale:v 0 -g {iframe_interval}
-      -vcodec mpeg2video -f rawvideo -y
-      {motion_vid}
-    ''', output_pipe=send_pipe)
+    # grab the motion vectors in each frame
+    _, _, motion_json = get_mushroom_temp_paths(clip_num)
+    return read_ffedit_vectors(motion_json)
 
-    # assemble a JS script string to apply the motion vectors
+
+def get_mushroom_vectors_key(alignment):
+    '''
+    A clip's mushroom vectors only depend on where it's cut from the timelapse
+    (and the code/params that cut and extract it),
+    not on the outro chunk it gets applied to.
+    '''
+    hasher = hashlib.sha256()
+    hash_code(hasher, get_mushroom_vector_cmds, set())
+    hash_code(hasher, read_mushroom_vectors, set())
+    hash_value(hasher, tuple(alignment))
+    hash_input(hasher, 'media/mushroom_timelapse.mp4')
+    return hasher.hexdigest()
+
+
+def get_vector_script(vectors, mask, method='add'):
+    # assemble a JS script string to apply the motion vectors.
+    # each frame's vectors are a flat "x,y,x,y,..." string (row-major, blank
+    # for macroblocks without one) that's only split when its frame comes up,
+    # so the script is cheap to parse and only one frame is unpacked at a time
     # TODO: new versions of ffedit support python script inputs...
     to_add = '+' if method == 'add' else ''
-    script_contents = '''
-        var vectors = ''' + json.dumps(vectors) + ''';
+    num_rows, num_cols = vectors.shape[1:3]
+    return '''
+        var vectors = ''' + json.dumps(get_vector_strings(vectors, mask)) + ''';
+        var vector_rows = ''' + str(num_rows) + ''';
+        var vector_cols = ''' + str(num_cols) + ''';
         var n_frames = 0;
 
         function glitch_frame(frame) {
             frame["mv"]["overflow"] = "truncate";
             let fwd_mvs = frame["mv"]["forward"];
-            if (!fwd_mvs || !vectors[n_frames]) {
-                n_frames++;
+            let frame_vectors = n_frames < vectors.length ? vectors[n_frames] : "";
+            n_frames++;
+            if (!fwd_mvs || !frame_vectors) {
                 return;
             }
 
-            for ( let i = 0; i < fwd_mvs.length; i++ ) {
+            let values = frame_vectors.split(",");
+            let num_rows = Math.min(fwd_mvs.length, vector_rows);
+            for ( let i = 0; i < num_rows; i++ ) {
                 let row = fwd_mvs[i];
-                for ( let j = 0; j < row.length; j++ ) {
+                let num_cols = Math.min(row.length, vector_cols);
+                let row_start = i * vector_cols * 2;
+                for ( let j = 0; j < num_cols; j++ ) {
                     let mv = row[j];
-                    try {
-                        mv[0] ''' + to_add + '''= vectors[n_frames][i][j][0];
-                        mv[1] ''' + to_add + '''= vectors[n_frames][i][j][1];
-                    } catch {}
+                    let k = row_start + j*2;
+                    if (!mv || values[k] === "") {
+                        continue;
+                    }
+                    mv[0] ''' + to_add + '''= +values[k];
+                    mv[1] ''' + to_add + '''= +values[k+1];
                 }
             }
-
-            n_frames++;
         }
     '''
 
-    # write the code to a .js file
-    # and apply the script
-    script_path = f'apply_vectors{chunk_num}.js'
-    with open(script_path, 'w') as f:
-        f.write(script_contents)
-    ffedit(
-        f'-i {motion_vid} -f mv -s {script_path} -o {output_video}',
-        output_pipe=send_pipe,
-        last_stage=True
-    )
-
-    os.remove(script_path)
-    os.remove(motion_vid)
-
-
-def mushroom_motion_chunk(chunk_num, mushroom_alignments, send_pipe):
-    cut_mushroom_timelapse(chunk_num, mushroom_alignments, send_pipe)
-    transfer_motion_vectors(chunk_num, send_pipe)
-
 
+@stage(
+    outputs=[
+        get_frame_store_path('outro_mushroom_motion'),
+        *[ f'media/outro_cut{chunk_num}.mp4' for chunk_num in range(num_chunks) ],
+        *[ f'media/outro_mushroom_motion{chunk_num}.mpg' for chunk_num in range(num_chunks) ],
+    ],
+    deps=['remove_iframes'],
+    inputs=['media/mushroom_timelapse.mp4'],
+)
 def add_mushroom_motion():
-    if os.path.exists('media/frames/outro_mushroom_motion'):
-        return
     prinnit('Applying mushroom timelapse motion vectors to outro...')
-    # cut the outro into chunks
-    cut_outro()
-    # cut the mushroom timelapse into same-sized chunks
-    # and transfer the motion from the mushroom chunks
-    # to the outro chunks (in parallel)
-    subprocess_pool(mushroom_motion_chunk, list(enumerate(mushroom_chunks)))
+    # cut the outro into chunks, and the mushroom timelapse into 2-bar clips,
+    # and get them ready for ffedit (all in parallel, from this process).
+    # each clip's vectors are cached in media/mv_cache,
+    # since they don't depend on the outro (or which chunk the clip is in)
+    clip_keys = {
+        tuple(alignment) : get_mushroom_vectors_key(alignment)
+        for alignments in mushroom_chunks
+        for alignment in alignments
+    }
+    # split the stage's threads between the chunks running at once
+    budget = get_thread_budget() or os.cpu_count()
+    concurrency = min(budget, num_chunks)
+    threads = max(budget // concurrency, 1)
+    jobs = [
+        [
+            get_outro_cut_cmd(chunk_num, threads),
+            get_mpeg2_cmd(f'media/outro_cut{chunk_num}.mp4', f'tmp_outro{chunk_num}.mpg', 10000, threads),
+        ]
+        for chunk_num in range(num_chunks)
+    ]
+    # the clips that aren't cached yet (numbered for their temp files)
+    extracting = [ (alignment, key) for alignment, key in clip_keys.items() if not has_cached_vectors(key) ]
+    for clip_num, (alignment, key) in enumerate(extracting):
+        jobs.append(get_mushroom_vector_cmds(clip_num, alignment, threads))
+    print(f'Extracting {len(extracting)} of {len(clip_keys)} mushroom vector clips')
+    # the intermediate files, removed even if something fails
+    # (so a failed run doesn't leave files behind that the next one trips over)
+    temp_paths = [
+        *[ path for clip_num in range(len(extracting)) for path in get_mushroom_temp_paths(clip_num) ],
+        *[ f'tmp_outro{chunk_num}.mpg' for chunk_num in range(num_chunks) ],
+        *[ f'apply_vectors{chunk_num}.js' for chunk_num in range(num_chunks) ],
+    ]
+    try:
+        run_commands(jobs, max_concurrency=concurrency)
+        for clip_num, (alignment, key) in enumerate(extracting):
+            save_cached_vectors(key, *read_mushroom_vectors(clip_num))
+
+        # transfer the motion from each chunk's mushroom clips to the outro chunks
+        for chunk_num, mushroom_alignments in enumerate(mushroom_chunks):
+            clip_vectors = [ load_cached_vectors(clip_keys[tuple(alignment)]) for alignment in mushroom_alignments ]
+            vectors, mask = resample_vectors(
+                np.concatenate([ vectors for vectors, _ in clip_vectors ]),
+                np.concatenate([ mask for _, mask in clip_vectors ]),
+                tuple(map(int, motion_scale.split(':'))),
+                tuple(map(int, outro_motion_scale.split(':')))
+            )
+            # write the code to a .js file
+            with open(f'apply_vectors{chunk_num}.js', 'w') as f:
+                f.write(get_vector_script(vectors, mask))
+        # and apply the scripts
+        run_commands([
+            [ get_ffmpeg_cmd(f'''
+                -i tmp_outro{chunk_num}.mpg -f mv -s apply_vectors{chunk_num}.js
+                -o media/outro_mushroom_motion{chunk_num}.mpg
+              ''', alt_binary='ffedit') ]
+            for chunk_num in range(num_chunks)
+        ], max_concurrency=concurrency)
+    finally:
+        remove_outputs(temp_paths)
+
     # and then combine the chunks
-    subprocess.run('mkdir -p media/frames/outro_mushroom_motion', check=True, shell=True)
+    mushrooms = make_frame_store('outro_mushroom_motion')
     ffmpeg_inputs, concat_inputs = zip(*[
         (f'-i media/outro_mushroom_motion{chunk_num}.mpg', f'[{chunk_num}:v]')
         for chunk_num in range(num_chunks)
@@ -256,73 +373,83 @@ def add_mushroom_motion():
     ffmpeg(f'''
       {ffmpeg_inputs}
       -filter_complex "{concat_inputs} concat=n={num_chunks}:v=1:a=0, scale={crop} [outv]"
-      -map [outv] "media/frames/outro_mushroom_motion/%06d.png"
-    ''')
+      -map [outv]
+    ''', mushrooms.ffmpeg_output())
 
 
 def overlay_one_frame(
-    dancer_fade_in,fade_out_start, dancer_fade_out,
+    stores, dancer_fade_in, fade_out_start, dancer_fade_out,
     blend_start, dancer_blend, frame_num
 ):
     original_frame_num = frame_num+s_to_f(outro_start)
-    out_path = f'media/frames/outro_masked/{frame_num:06d}.png'
-    mushrooms_path = f'media/frames/outro_mushroom_motion/{frame_num:06d}.png'
-    dancer_path = f'media/frames/dancers/{original_frame_num:06d}.png'
-    dancer_glitch_path = f'media/frames/outro_dancers_glitch/{frame_num:06d}.png'
-    mask_path = f'media/frames/dancers_mask/{original_frame_num:06d}.npy'
+    outro_masked = stores['outro_masked']
+    mushroom_motion = stores['outro_mushroom_motion']
 
     fade_in_end = len(dancer_fade_in)
     fade_out_end = fade_out_start + len(dancer_fade_out)
 
     if frame_num >= fade_out_end:
-        shutil.copyfile(mushrooms_path, out_path)
+        outro_masked.copy(mushroom_motion, frame_num)
         return
 
-    mask = get_mask(mask_path)
+    mask = get_mask(original_frame_num, as_alpha=True)
     if frame_num < fade_in_end:
-        mask = mask * dancer_fade_in[frame_num-1]
+        mask = scale(mask, dancer_fade_in[frame_num-1])
     if frame_num >= fade_out_start:
-        mask = mask * dancer_fade_out[frame_num-fade_out_start]
-    mask = np.stack((mask,) * 3, axis=-1)
+        mask = scale(mask, dancer_fade_out[frame_num-fade_out_start])
 
-    mushrooms = cv2.imread(mushrooms_path)
-    dancers = cv2.imread(dancer_path)
-    dancers_glitch = cv2.imread(dancer_glitch_path)
+    mushrooms = mushroom_motion[frame_num]
+    dancers = stores['outro_dancers'][original_frame_num]
     if frame_num >= blend_start:
         dancer_pct = dancer_blend[frame_num-blend_start]
-        dancers_blended = cv2.addWeighted(dancers, dancer_pct, dancers_glitch, 1-dancer_pct, 0)
-    else:
-        dancers_blended = dancers
-    final_img = apply_mask(mask, dancers_blended, mushrooms)
-    cv2.imwrite(out_path, final_img)
+        dancers_glitch = stores['outro_dancers_glitch'][frame_num]
+        blend(to_alpha(dancer_pct), dancers, dancers_glitch, out=dancers)
+    final_img = blend(mask, dancers, mushrooms, out=mushrooms)
+    outro_masked[frame_num] = final_img
 
 
-def overlay_dancers_on_mushroom_motion():
-    if os.path.exists('media/frames/outro_masked'):
-        return
-    prinnit('Overlaying dancers on glitched mushroom motion outro...')
-    subprocess.run('mkdir -p media/frames/outro_masked', check=True, shell=True)
+def overlay_frames(dancer_fade_in, fade_out_start, dancer_fade_out, blend_start, dancer_blend, frame_range):
+    '''
+    Overlay a range of outro frames (opening their frame stores once for all of them).
+    Returns how many frames it did.
+    '''
+    stores = {
+        name : get_frame_store(name)
+        for name in ('outro_masked', 'outro_mushroom_motion', 'outro_dancers', 'outro_dancers_glitch')
+    }
+    start, end = frame_range
+    for frame_num in range(start, end):
+        overlay_one_frame(
+            stores, dancer_fade_in, fade_out_start, dancer_fade_out,
+            blend_start, dancer_blend, frame_num
+        )
+    return end - start
+
 
-    if not os.path.exists('media/frames/outro_dancers_glitch'):
-        subprocess.run('mkdir -p media/frames/outro_dancers_glitch', check=True, shell=True)
-        ffmpeg(f'''
-          -i media/glitch_output.avi
-          -vf "trim=start_frame={s_to_f(outro_start)}, setpts=PTS-STARTPTS"
-          "media/frames/outro_dancers_glitch/%06d.png"
-        ''')
+@stage(
+    outputs=[get_frame_store_path('outro_masked'), get_frame_store_path('outro_dancers_glitch')],
+    deps=['collect_dancer_masks', 'key_outro_dancers', 'remove_iframes', 'add_mushroom_motion'],
+)
+def overlay_dancers_on_mushroom_motion(chunk_frames=50):
+    prinnit('Overlaying dancers on glitched mushroom motion outro...')
+    dancers_glitch = make_frame_store('outro_dancers_glitch')
+    ffmpeg(f'''
+      -i media/glitch_output.avi
+      -vf "trim=start_frame={s_to_f(outro_start)}, setpts=PTS-STARTPTS"
+    ''', dancers_glitch.ffmpeg_output())
 
     # fade the dancers in to not diminish mushroom explosion
     fade_in_end = s_to_f(2*bar_dur) + 1
     dancer_fade_in = np.linspace(0, 1, num=fade_in_end)
     # halfway thru the 3rd round, fade away the dancer to pinkness
     fade_out_start = s_to_f(20*bar_dur) + 1
-    fade_out_end = s_to_f(24*bar_dur) + 1
+    fade_out_end = outro_dancers_end_frame
     dancer_fade_out = np.linspace(1, 0, num=fade_out_end-fade_out_start)
     # gradually blend in the glitched dancer
     blend_start = s_to_f(8*bar_dur) + 1
     dancer_blend = np.linspace(1, 0, num=fade_out_end - blend_start)
     pfunc = partial(
-        overlay_one_frame,
+        overlay_frames,
         dancer_fade_in,
         fade_out_start,
         dancer_fade_out,
@@ -330,10 +457,12 @@ def overlay_dancers_on_mushroom_motion():
         dancer_blend
     )
 
-    num_frames = min(
-        len(glob('media/frames/outro_dancers_glitch/*.png')),
-        len(glob('media/frames/outro_mushroom_motion/*.png'))
-    )
-    with Pool() as party:
-        for _ in tqdm(party.imap(pfunc, range(1, num_frames+1)), total=num_frames):
-            pass
+    num_frames = min(len(dancers_glitch), len(get_frame_store('outro_mushroom_motion')))
+    make_frame_store('outro_masked', num_frames)
+    frame_ranges = [
+        (start, min(start + chunk_frames, num_frames+1))
+        for start in range(1, num_frames+1, chunk_frames)
+    ]
+    with Pool(get_thread_budget(), cv2.setNumThreads, (1,)) as party, tqdm(total=num_frames) as pbar:
+        for num_done in party.imap_unordered(pfunc, frame_ranges):
+            pbar.update(num_done)
@@ -23,5 +23,5 @@ if __name__ == '__main__':
            "fps={fps}, scale=480:-1:flags=lanczos, split [img1][img2];
             [img1] palettegen=max_colors=32 [palette];
             [img2][palette] paletteuse=dither=bayer"
-          -y {gif_dir}/{filename}.gif
-        ''')
+          -y
+        ''', f'{gif_dir}/{filename}.gif')
@@ -1,19 +1,44 @@
-from multiprocessing import Pipe, Pool
+import asyncio
+import os
 import subprocess
-import sys
 
 
-def pipe_subprocess_output(cmd, output_pipe, last_stage=False):
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-    is_running = True
-    while is_running:
-        is_running = process.poll() is None
-        line = process.stdout.readline().strip()
-        if line:
-            output_pipe.send(line)
-    # signal the start of a new stage for this process
-    if not last_stage:
-        output_pipe.send('NEWLINE')
+# the keys ffmpeg writes with -progress (one key=value per line),
+# ending each update with progress=continue (or progress=end)
+progress_keys = {
+    'frame', 'fps', 'bitrate', 'total_size',
+    'out_time_us', 'out_time_ms', 'out_time',
+    'dup_frames', 'drop_frames', 'speed', 'progress',
+}
+# don't redraw the progress more often than this (in seconds)
+redraw_interval = 0.1
+
+def parse_output_line(progress, line):
+    '''
+    Turn a line of command output into a progress message:
+    a {frame, fps, speed} dict at the end of each ffmpeg -progress update,
+    the line itself if it isn't part of one, or None.
+    (`progress` collects the keys of the update in between.)
+    '''
+    key, is_pair, value = line.partition('=')
+    if is_pair and (key in progress_keys or key.startswith('stream_')):
+        progress[key] = value
+        if key != 'progress':
+            return None
+        message = {
+            'frame' : progress.get('frame'),
+            'fps'   : progress.get('fps'),
+            'speed' : progress.get('speed'),
+        }
+        progress.clear()
+        return message
+    return line or None
+
+
+def format_progress(message):
+    if isinstance(message, dict):
+        return f"frame={message['frame']} fps={message['fps']} speed={message['speed']}"
+    return message
 
 
 def print_process_progress(outputs, num_clear_lines=0):
@@ -27,34 +52,92 @@ def print_process_progress(outputs, num_clear_lines=0):
             print(line)
 
 
-def subprocess_pool(func, args):
-    # append the sender end of the pipes to the args,
-    # so that each of the subprocesses
-    # can report their progress in parallel
-    # (`send_pipe` is passed along into `pipe_subprocess_output` above)
-    recv_pipes, send_pipes = zip(*[ Pipe(duplex=False) for _ in args ])
-    args = [ (*a, send_pipe) for a, send_pipe in zip(args, send_pipes) ]
-    with Pool() as party:
-        processes = party.starmap_async(func, args, error_callback=print)
-        last_outputs = [ ['...'] for _ in recv_pipes ]
-        print_process_progress(last_outputs)
-        while not processes.ready():
-            num_clear_lines = 0
-            for i, pipe in enumerate(recv_pipes):
-                if pipe.poll():
-                    line = pipe.recv()
-                    # only get the number of lines to clear
-                    # on the first time per loop,
-                    # in case multiple chunks send "DONE"
-                    if not num_clear_lines:
-                        num_clear_lines = sum(map(lambda out: len(out), last_outputs))
-                    # each parallel process has multiple steps.
-                    # make a new line for the new step
-                    if line == 'NEWLINE':
-                        last_outputs[i].append('...')
-                    else:
-                        last_outputs[i][-1] = line
-            if num_clear_lines:
-                print_process_progress(last_outputs, num_clear_lines)
-        if not processes.successful():
-            sys.exit()
+def redraw(display):
+    print_process_progress(display['outputs'], display['num_lines'])
+    display['num_lines'] = sum(map(len, display['outputs']))
+
+
+async def render(display):
+    '''
+    Redraw whenever a command reports something, but at most every redraw_interval.
+    '''
+    while True:
+        await display['changed'].wait()
+        display['changed'].clear()
+        redraw(display)
+        await asyncio.sleep(redraw_interval)
+
+
+async def run_command(cmd, job_num, display, timeout):
+    process = await asyncio.create_subprocess_exec(
+        *cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+    )
+    progress = {}
+
+    async def relay_output():
+        # read until the process closes its output, so the last lines aren't lost
+        async for line in process.stdout:
+            message = parse_output_line(progress, line.decode(errors='replace').strip())
+            if message is not None:
+                display['outputs'][job_num][-1] = format_progress(message)
+                display['changed'].set()
+        return await process.wait()
+
+    try:
+        returncode = await asyncio.wait_for(relay_output(), timeout)
+    finally:
+        # timed out or cancelled because another command failed
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+
+async def run_job(commands, job_num, semaphore, display, timeout):
+    for step, cmd in enumerate(commands):
+        # each job has multiple steps.
+        # make a new line for the new step
+        if step:
+            display['outputs'][job_num].append('...')
+        async with semaphore:
+            await run_command(cmd, job_num, display, timeout)
+
+
+async def run_jobs(jobs, max_concurrency, timeout):
+    semaphore = asyncio.Semaphore(max_concurrency or os.cpu_count())
+    display = {
+        'outputs'   : [ ['...'] for _ in jobs ],
+        'num_lines' : 0,
+        'changed'   : asyncio.Event(),
+    }
+    redraw(display)
+    renderer = asyncio.ensure_future(render(display))
+    tasks = [
+        asyncio.ensure_future(run_job(commands, job_num, semaphore, display, timeout))
+        for job_num, commands in enumerate(jobs)
+    ]
+    try:
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        # fail fast, stopping everything else that's running
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        for task in done:
+            task.result()
+    finally:
+        renderer.cancel()
+        redraw(display)
+
+
+def run_commands(jobs, max_concurrency=None, timeout=None):
+    '''
+    Run lists of commands (argv lists, e.g. from get_ffmpeg_cmd) from this process:
+    the commands in each list one after another, and the lists in parallel,
+    with at most `max_concurrency` commands (default: the number of CPUs) at a time.
+    Shows the latest progress of each list as it goes.
+    Each command is killed after `timeout` seconds,
+    and the first failure stops the rest and raises its error.
+    '''
+    if jobs:
+        asyncio.run(run_jobs(jobs, max_concurrency, timeout))
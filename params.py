@@ -1,17 +1,21 @@
-from glob import glob
+from contextlib import contextmanager
+from functools import lru_cache
 import shlex
 import subprocess
 
 import cv2
 import numpy as np
 
-from multisubprocess import pipe_subprocess_output
+from framestore import PngFrameStore, QoiFrameStore, RawFrameStore
+from stages import get_thread_budget
 
 
 # video output settings
 fps = 30
 crop = '1280:720'
 cropx = '1280x720'
+# the numpy shape of a frame's mask
+frame_shape = (720, 1280)
 crop_filter = f'scale={crop}:force_original_aspect_ratio=increase, crop={crop}, setsar=1'
 # the dancers video has some transfer artifacts we crop away
 dancers_crop_filter = f'crop=x=20:w=iw-40:y=10:h=ih-20, {crop_filter}'
@@ -112,12 +116,18 @@ fire_trail_start = s_to_f(chorus1_end + 4*bar_dur)
 fire_trail_end = s_to_f(chorus2_start - 4*bar_dur)
 fire_trail_dur = fire_trail_end - fire_trail_start
 fire_trail_memory_fade = 2*bar_dur
+# the trail is at most a bar
+fire_trail_max_memory = s_to_f(bar_dur)
 fade2_start = bridge_start
 fade2_start_frame = s_to_f(fade2_start)
 fade2_end = bridge_violin_start
 fade2_end_frame = s_to_f(fade2_end)
 glitch_start_frame = s_to_f(bridge_violin_start)
 bridge_fire_start = s_to_f(synth_arp_start)
+# which bridge frames flicker with fire
+fire_bridge_path = 'media/fire_bridge.json'
+# the outro dancers have faded away to pinkness by this outro frame
+outro_dancers_end_frame = s_to_f(24*bar_dur) + 1
 
 # utility functions
 def prinnit(it):
@@ -125,21 +135,40 @@ def prinnit(it):
     print(it)
     print('*' * 50)
 
-def ffmpeg(multiline_cmd, alt_binary=None, output_pipe=None, quiet=True, **kwargs):
+def get_ffmpeg_cmd(multiline_cmd, output=None, alt_binary=None, quiet=True, stats=True, progress=False, threads=None):
+    '''
+    `output` is the output file and its output options (e.g. a frame store's ffmpeg_output()),
+    it goes after everything in `multiline_cmd`.
+    '''
     quiet_args = ['-v', 'warning'] if quiet else []
-    # ffedit doesn't have the -stats arg
-    if quiet and alt_binary != 'ffedit':
+    # ffedit doesn't have the -stats or -progress args
+    if progress and alt_binary != 'ffedit':
+        # machine readable progress on stdout (see multisubprocess.run_commands)
+        quiet_args += ['-nostats', '-progress', 'pipe:1']
+    elif quiet and stats and alt_binary != 'ffedit':
         quiet_args.append('-stats')
-    cmd = [
+    args = shlex.split(multiline_cmd.replace('\n', ''))
+    output_args = shlex.split(output.replace('\n', '')) if output else []
+    # stay within the running stage's share of the cores
+    # (-threads as an output option limits the output's encoder)
+    threads = threads or get_thread_budget()
+    if threads and alt_binary != 'ffedit':
+        args = ['-filter_threads', str(threads), *args]
+        # -filter_threads doesn't cover -filter_complex graphs
+        if '-filter_complex' in args:
+            args = ['-filter_complex_threads', str(threads), *args]
+        if output_args:
+            output_args = ['-threads', str(threads), *output_args]
+    return [
         alt_binary or 'ffmpeg',
         *quiet_args,
-        *shlex.split(multiline_cmd.replace('\n', ''))
+        *args,
+        *output_args
     ]
 
-    if output_pipe is None:
-        subprocess.run(cmd, check=True)
-    else:
-        pipe_subprocess_output(cmd, output_pipe, **kwargs)
+def ffmpeg(multiline_cmd, output=None, alt_binary=None, quiet=True):
+    cmd = get_ffmpeg_cmd(multiline_cmd, output, alt_binary=alt_binary, quiet=quiet)
+    subprocess.run(cmd, check=True)
 
 def ffgac(multiline_cmd, **kwargs):
     ffmpeg(multiline_cmd, alt_binary='ffgac', **kwargs)
@@ -147,6 +176,89 @@ def ffgac(multiline_cmd, **kwargs):
 def ffedit(multiline_cmd, **kwargs):
     ffmpeg(multiline_cmd, alt_binary='ffedit', **kwargs)
 
+# rawvideo pixel formats we pass to/from numpy, and their channel counts
+pix_fmt_channels = {
+    'gray'  : 1,
+    'bgr24' : 3,
+    'bgra'  : 4,
+}
+
+def get_frame_shape(size, pix_fmt):
+    width, height = map(int, size.split('x'))
+    channels = pix_fmt_channels[pix_fmt]
+    return (height, width) if channels == 1 else (height, width, channels)
+
+def ffmpeg_frames(input, filters=None, pix_fmt='bgr24', size=cropx):
+    '''
+    Decode frames with ffmpeg and yield them one at a time as numpy arrays,
+    without writing anything to disk.
+    `input` is the input args (e.g. '-ss 10 -i media/fire.mp4'),
+    `filters` is an optional filtergraph for -vf,
+    and the frames are scaled to `size` if they aren't already.
+    '''
+    shape = get_frame_shape(size, pix_fmt)
+    frame_size = int(np.prod(shape))
+    vf = f'-vf "{filters}"' if filters else ''
+    cmd = get_ffmpeg_cmd(f'''
+      {input} {vf}
+    ''', f'-f rawvideo -pix_fmt {pix_fmt} -s {size} pipe:1', stats=False)
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    is_done = False
+    try:
+        while True:
+            frame = bytearray(frame_size)
+            num_read = 0
+            while num_read < frame_size:
+                more = process.stdout.readinto(memoryview(frame)[num_read:])
+                if not more:
+                    break
+                num_read += more
+            if num_read == 0:
+                is_done = True
+                break
+            if num_read < frame_size:
+                raise ValueError(f'ffmpeg output ended partway thru a frame: {shlex.join(cmd)}')
+            yield np.frombuffer(frame, dtype='uint8').reshape(shape)
+    finally:
+        # if we stopped early, we don't need the rest
+        if not is_done:
+            process.kill()
+        process.stdout.close()
+        returncode = process.wait()
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+@contextmanager
+def frame_sink(output, filters=None, pix_fmt='bgr24', size=cropx, framerate=fps):
+    '''
+    Encode numpy frames with ffmpeg.
+    Yields a function that takes one frame at a time;
+    `output` is the output args (e.g. '-start_number 100 "media/frames/x/%06d.png"').
+    '''
+    shape = get_frame_shape(size, pix_fmt)
+    vf = f'-vf "{filters}"' if filters else ''
+    cmd = get_ffmpeg_cmd(f'''
+      -f rawvideo -pix_fmt {pix_fmt} -s {size} -framerate {framerate} -i pipe:0
+      {vf}
+    ''', output, stats=False)
+    process = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+    def write(frame):
+        if frame.shape != shape or frame.dtype != np.uint8:
+            raise ValueError(f'Expected a uint8 frame of shape {shape}, got {frame.dtype} {frame.shape}')
+        process.stdin.write(np.ascontiguousarray(frame).data)
+
+    try:
+        yield write
+    except:
+        process.kill()
+        process.wait()
+        raise
+    process.stdin.close()
+    returncode = process.wait()
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
 def get_stretch_cmd(duration, stretch_duration_frames, use_minterpolate=False, gradually=False):
     '''
     Get the ffmpeg setpts command to stretch (or compress) the clip to the given duration.
@@ -164,24 +276,132 @@ def get_stretch_cmd(duration, stretch_duration_frames, use_minterpolate=False, g
         stretch_cmd = f"setpts=PTS-STARTPTS, setpts='((T/{stretch_duration}*{stretch-1})+1)*PTS'"
     return stretch_cmd
 
+# each shard of a sharded stretch also interpolates this much (in seconds) of the input
+# on either side, so minterpolate and fps see the same neighboring frames as a single pass would
+stretch_shard_margin = 0.2
+
+def get_stretch_curve(stretch, gradually=False, curve_duration=None):
+    '''
+    The setpts expression for a stretch (on timestamps counted from the start of the clip),
+    like get_stretch_cmd's: constant, or slowing down linearly ('gradually')
+    to `stretch` times slower after curve_duration seconds of output.
+    '''
+    if gradually:
+        return f"'((T/{curve_duration}*{stretch-1})+1)*PTS'"
+    return f'{stretch}*PTS'
+
+def get_stretch_input_time(out_time, stretch, gradually=False, curve_duration=None):
+    '''
+    Invert a stretch curve: how far into the clip (in seconds) the frame at out_time comes from.
+    '''
+    if not gradually or stretch == 1:
+        return out_time / stretch
+    # out_time = (t * (stretch-1)/curve_duration + 1) * t
+    a = (stretch - 1) / curve_duration
+    return (np.sqrt(1 + 4*a*out_time) - 1) / (2*a)
+
+def get_stretch_shard_cmds(
+    input_path, clip_start, num_frames, out_store, stretch, interpolate_fps,
+    gradually=False, curve_duration=None, start_number=1, end_time=None,
+    filters='', num_shards=None, threads=None
+):
+    '''
+    ffmpeg commands that minterpolate and stretch a clip into num_frames frames of `out_store`,
+    each making a contiguous shard of the frames, so they can run in parallel
+    (e.g. with multisubprocess.run_commands).
+    The clip starts clip_start seconds into the input,
+    and ends end_time seconds after that (default: wherever the input does),
+    and `filters` are applied to the stretched frames.
+    Each shard interpolates from a bit before its first frame, on the same timestamps
+    (from the clip's first frame, like get_stretch_cmd),
+    and drops everything outside its frames, so the shards meet at exact frame numbers.
+    (They're identical to a single pass when interpolate_fps is a multiple of the input's.)
+    '''
+    num_shards = min(num_shards or get_thread_budget() or 1, num_frames)
+    curve_duration = curve_duration or num_frames / fps
+    curve = get_stretch_curve(stretch, gradually, curve_duration)
+    bounds = np.linspace(0, num_frames, num_shards + 1).round().astype(int)
+    cmds = []
+    for first_frame, end_frame in zip(bounds[:-1], bounds[1:]):
+        # decoding is cheap next to minterpolate, so decode the clip from its start,
+        # getting the same timestamps as a single pass
+        start = get_stretch_input_time(first_frame / fps, stretch, gradually, curve_duration)
+        start = max(start - stretch_shard_margin, 0)
+        end = get_stretch_input_time(end_frame / fps, stretch, gradually, curve_duration)
+        end += stretch_shard_margin
+        if end_time is not None:
+            end = min(end, end_time)
+        shard_filters = f'''
+          setpts=PTS-STARTPTS, trim=start={start}:end={end},
+          minterpolate=mi_mode=mci:fps={interpolate_fps},
+          setpts={curve}, fps={fps},
+          trim=start_pts={first_frame}:end_pts={end_frame}, setpts=PTS-STARTPTS'''
+        if filters:
+            shard_filters += f', {filters}'
+        cmds.append(get_ffmpeg_cmd(f'''
+          -ss {clip_start} -i {input_path}
+          -vf "{shard_filters}" -an -r {fps}
+        ''', out_store.ffmpeg_output(start_number + first_frame), progress=True, threads=threads))
+    return cmds
+
+# how the intermediate frames (media/frames/<name>) are stored (see framestore.py):
+# 'png', 'qoi' (needs the qoi package),
+# or 'raw' (one preallocated volume, which ffmpeg can read but not write,
+# so only for frames written from python, i.e. interweaved and outro_masked)
+frame_store_backend = 'png'
+# backends for particular frames, overriding frame_store_backend
+# (e.g. {'interweaved': 'raw'})
+frame_store_backends = {}
+# the zlib level of png frames, from 0 (fastest) to 9 (smallest)
+png_compression = 1
+
+def get_frame_store_path(name):
+    '''
+    Where the frames called `name` are stored (for stage outputs).
+    '''
+    if frame_store_backends.get(name, frame_store_backend) == 'raw':
+        return f'media/frames/{name}.npy'
+    return f'media/frames/{name}'
+
+def get_frame_store(name):
+    '''
+    The FrameStore of the frames called `name`.
+    '''
+    backend = frame_store_backends.get(name, frame_store_backend)
+    path = get_frame_store_path(name)
+    shape = (*frame_shape, 3)
+    if backend == 'png':
+        return PngFrameStore(path, shape, png_compression)
+    if backend == 'qoi':
+        return QoiFrameStore(path, shape)
+    if backend == 'raw':
+        return RawFrameStore(path, shape)
+    raise ValueError(f'Unknown frame store backend: {backend}')
+
+def make_frame_store(name, num_frames=None):
+    '''
+    A FrameStore for writing the frames called `name`
+    (a raw one has room for `num_frames`).
+    '''
+    store = get_frame_store(name)
+    store.create(num_frames)
+    return store
+
 def get_num_dancer_frames():
-    return len(glob('media/frames/dancers/*.png'))
+    return len(get_frame_store('dancers'))
 
 num_wave_frames = None
 num_slow_wave_frames = None
 # loop the 17 seconds of waves
-def get_wave_file(frame_num, is_slow=False):
+def get_wave_frame(frame_num, is_slow=False):
     global num_wave_frames, num_slow_wave_frames
-    if num_wave_frames is None:
-        num_wave_frames = len(glob('media/frames/waves/*.png'))
-    if num_slow_wave_frames is None:
-        num_slow_wave_frames = len(glob('media/frames/waves_slow/*.png'))
+    waves = get_frame_store('waves_slow' if is_slow else 'waves')
+    if is_slow and num_slow_wave_frames is None:
+        num_slow_wave_frames = len(waves)
+    if not is_slow and num_wave_frames is None:
+        num_wave_frames = len(waves)
     num_frames = num_slow_wave_frames if is_slow else num_wave_frames
-    wave_frame = (frame_num % num_frames) + 1
-    dir = 'waves'
-    if is_slow:
-        dir += '_slow'
-    return f'media/frames/{dir}/{wave_frame:06d}.png'
+    return waves[(frame_num % num_frames) + 1]
 
 def oscillate(value1, value2, pulse_dur, how_many=1, num_frames=None, offset=0):
     num_frames = num_frames or s_to_f(pulse_dur * how_many)
@@ -193,18 +413,167 @@ def oscillate(value1, value2, pulse_dur, how_many=1, num_frames=None, offset=0):
     pulse_amplitude = abs(value1 - value2) / 2
     return x * pulse_amplitude + (pulse_amplitude + min(value1, value2))
 
-def get_mask(mask_file, as_alpha=False):
-    mask = np.load(mask_file)
-    mask = np.asarray(mask * 255, dtype='uint8')
+# the dancer pose masks are quantized and kept in one uint8 volume
+# (at the resolution segmentation ran at),
+# indexed by frame number (the same numbering as the frame files),
+# with a sidecar saying which frames have a mask and its bounding box
+mask_store_path = 'media/frames/dancers_mask.npy'
+mask_index_path = 'media/frames/dancers_mask_index.npz'
+mask_blur = 15
+# masks stored at a lower resolution than the frames are upsampled when they're used,
+# either 'linear' or 'guided' (edge-aware, snapping to the edges of the dancer frame)
+mask_upsampling = 'linear'
+# the same mask gets used for lots of neighboring frames,
+# so keep the last few blurred masks around
+# (enough to cover interweave's random deviation window)
+mask_cache_size = 32
+
+def create_mask_store(num_frames, shape=frame_shape):
+    '''
+    Allocate an empty mask volume to be filled in by `save_mask`.
+    (Frames that never get a mask are never written, so they don't take up disk.)
+    '''
+    volume = np.lib.format.open_memmap(
+        mask_store_path, mode='w+', dtype='uint8', shape=(num_frames, *shape)
+    )
+    index = {
+        'coverage' : np.zeros(num_frames, dtype=bool),
+        # y0, y1, x0, x1 of the nonzero pixels
+        'bbox'     : np.zeros((num_frames, 4), dtype='int16'),
+    }
+    return volume, index
+
+def quantize_mask(mask):
+    return np.asarray(mask * 255, dtype='uint8')
+
+def save_mask(volume, index, frame_num, mask):
+    volume[frame_num - 1] = quantize_mask(mask)
+    index_mask(volume, index, frame_num)
+
+def index_mask(volume, index, frame_num):
+    '''
+    Mark a frame's mask (already written to the volume) as present.
+    '''
+    i = frame_num - 1
+    index['coverage'][i] = True
+    index['bbox'][i] = get_mask_bbox(volume[i])
+
+def get_mask_bbox(mask):
+    '''
+    The y0, y1, x0, x1 of a mask's nonzero pixels (all 0 if there aren't any).
+    '''
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if not len(rows):
+        return (0, 0, 0, 0)
+    return (rows[0], rows[-1]+1, cols[0], cols[-1]+1)
+
+def open_mask_volume():
+    '''
+    The mask volume being filled in, for writing from other processes.
+    '''
+    return np.load(mask_store_path, mmap_mode='r+')
+
+def close_mask_store(volume, index):
+    volume.flush()
+    np.savez(mask_index_path, **index)
+
+mask_store = None
+def open_mask_store():
+    global mask_store
+    if mask_store is None:
+        index = np.load(mask_index_path)
+        mask_store = {
+            'volume'   : np.load(mask_store_path, mmap_mode='r'),
+            'coverage' : index['coverage'],
+            'bbox'     : index['bbox'],
+        }
+    return mask_store
+
+def has_mask(frame_num):
+    coverage = open_mask_store()['coverage']
+    return 0 < frame_num <= len(coverage) and coverage[frame_num-1]
+
+def guided_filter(guide, src, radius, eps=1e-3):
+    '''
+    Smooth `src` while keeping the edges in `guide` (both 0-1 float, same shape).
+    '''
+    size = (2*radius + 1, 2*radius + 1)
+    mean = lambda img: cv2.boxFilter(img, -1, size)
+    mean_guide, mean_src = mean(guide), mean(src)
+    var_guide = mean(guide * guide) - mean_guide * mean_guide
+    cov = mean(guide * src) - mean_guide * mean_src
+    a = cov / (var_guide + eps)
+    b = mean_src - a * mean_guide
+    return mean(a) * guide + mean(b)
+
+def upsample_mask(mask, bbox, frame_num=None, method=None):
+    '''
+    Scale a stored mask (and its bounding box) up to the frame size,
+    by `method` (default: mask_upsampling).
+    The 'guided' method needs the frame number, to use the dancer frame as the guide.
+    '''
+    method = method or mask_upsampling
+    height, width = frame_shape
+    scale_y, scale_x = height / mask.shape[0], width / mask.shape[1]
+    upsampled = cv2.resize(np.asarray(mask), (width, height), interpolation=cv2.INTER_LINEAR)
+    y0, y1, x0, x1 = bbox
+    if y1 <= y0:
+        return upsampled, bbox
+    # interpolation spreads the mask up to a source pixel further
+    y0, x0 = max(int((y0 - 1) * scale_y), 0), max(int((x0 - 1) * scale_x), 0)
+    y1, x1 = min(int(np.ceil((y1 + 1) * scale_y)), height), min(int(np.ceil((x1 + 1) * scale_x)), width)
+    if method == 'guided':
+        radius = int(np.ceil(max(scale_y, scale_x)))
+        y0, x0 = max(y0 - radius, 0), max(x0 - radius, 0)
+        y1, x1 = min(y1 + radius, height), min(x1 + radius, width)
+        dancer = cv2.cvtColor(get_frame_store('dancers')[frame_num], cv2.COLOR_BGR2GRAY)
+        guide = dancer[y0:y1, x0:x1].astype(np.float32) / 255
+        region = upsampled[y0:y1, x0:x1].astype(np.float32) / 255
+        refined = guided_filter(guide, region, radius)
+        upsampled[y0:y1, x0:x1] = np.clip(refined * 255 + 0.5, 0, 255).astype('uint8')
+    elif method != 'linear':
+        raise ValueError(f'Unknown mask upsampling method: {method}')
+    return upsampled, (y0, y1, x0, x1)
+
+def blur_mask(mask, bbox):
+    '''
+    Blur a uint8 mask with nonzero pixels inside bbox.
+    '''
     # mask = cv2.bilateralFilter(mask, 10, 75, 75)
     # mask = cv2.dilate(mask, None)
-    mask = cv2.blur(mask, (15, 15))
-    if as_alpha:
-        return mask
-    return mask / 255
-
-def apply_mask(mask, foreground, background, is_img=True):
-    masked = (foreground*mask) + (background*(1-mask))
-    if is_img:
-        masked = np.asarray(masked, dtype='uint8')
-    return masked
+    # everything further than the blur radius from the dancer stays 0,
+    # so only blur around the dancer
+    # (with enough margin that the blur's border handling sees only zeros)
+    blurred = np.zeros(mask.shape, dtype='uint8')
+    y0, y1, x0, x1 = bbox
+    if y1 > y0:
+        margin = mask_blur//2 + 1
+        y0, x0 = max(y0 - margin, 0), max(x0 - margin, 0)
+        y1, x1 = min(y1 + margin, mask.shape[0]), min(x1 + margin, mask.shape[1])
+        blurred[y0:y1, x0:x1] = cv2.blur(mask[y0:y1, x0:x1], (mask_blur, mask_blur))
+    return blurred
+
+@lru_cache(maxsize=mask_cache_size)
+def get_mask(frame_num, as_alpha=False):
+    '''
+    The blurred mask for a frame, as uint8 alpha or as a 0-1 float.
+    These are cached, so they're read-only.
+    '''
+    store = open_mask_store()
+    i = frame_num - 1
+    # a view into the volume, nothing is read until we blur it
+    mask = store['volume'][i]
+    bbox = store['bbox'][i]
+    if mask.shape != frame_shape:
+        mask, bbox = upsample_mask(mask, bbox, frame_num)
+    blurred = blur_mask(mask, bbox)
+    mask = blurred if as_alpha else blurred / 255
+    mask.flags.writeable = False
+    return mask
+
+def get_mask_cache_info():
+    '''
+    Hits/misses of the blurred mask cache (in this process).
+    '''
+    return get_mask.cache_info()
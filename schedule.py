@@ -0,0 +1,185 @@
+import numpy as np
+
+from params import *
+
+
+# what to do with each interweaved frame
+FIRE = 0
+COPY = 1
+RENDER = 2
+# the random dancer deviation always comes from this seed,
+# so the masks it will need are known before interweaving (see get_mask_need_set)
+deviation_seed = 0
+
+def plan_interweave(mask_exists=None):
+    '''
+    Decide everything about every interweaved frame up front,
+    so the frames themselves can be rendered in any order.
+    `mask_exists` says whether a dancer frame has a mask (default: has_mask).
+    Returns a dict of per-frame arrays:
+      source         - FIRE, COPY (the original dancer frame) or RENDER
+      wave_offset    - the frame number passed to get_wave_file
+      wave_is_slow   - whether that's a slow wave frame
+      waves_pct      - how much waves to blend into the dancer (nan if none)
+      mask_frame     - which dancer mask frame to use (-1 if none)
+      background_pct - how much background comes thru the mask (nan if none)
+      trail_len      - how many past masks make up the fire trail (0 if none)
+      trail_push     - whether this frame's mask is added to the trail history
+    '''
+    mask_exists = mask_exists or has_mask
+    # sometimes the real value does not equal the theoretical value...
+    total_frames = get_num_dancer_frames()
+
+    dancer_frames_start = 60
+    dancer_frames_slow = 30
+    dancer_frames_fast = 3
+
+    # once the verse enters,
+    # move the dancer into random chaos and back out in one verse, peaking at...
+    random_bars = 12
+    # the maximum random radius of frames around the current frame
+    max_deviation = 15
+
+    fire_sections = [
+        # start with infrequent fire frames, increasing linearly up to stage reveal, then disappear
+        [ 0, np.linspace(dancer_frames_start, dancer_frames_slow, num=s_to_f(bass_synth_start)).astype(int), 1 ],
+        # reappear at chorus, oscillate to high intensity two times
+        [ chorus1_start, oscillate(dancer_frames_slow, dancer_frames_fast, chorus1_duration / 2, how_many=2, offset=1).astype(int), 1 ],
+        # same at 2nd chorus (twice length)
+        [ chorus2_start, oscillate(dancer_frames_slow, dancer_frames_fast, chorus1_duration / 2, how_many=4, offset=1).astype(int), 1 ],
+    ]
+
+    # after verse, oscillate random dancer deviation
+    total_random_frames = total_frames - verse1_start_frame
+    deviation_radius = oscillate(0, max_deviation, bar_dur * random_bars, num_frames=total_random_frames, offset=-1)
+    deviation_radius = np.rint(deviation_radius)
+    random_deviation = np.random.RandomState(deviation_seed).rand(total_random_frames)
+    random_deviation = random_deviation * deviation_radius*2 - deviation_radius
+    random_deviation = random_deviation.astype(int)
+
+    # use the dancer mask
+    mask_start_frame = guitar_start_frame + s_to_f(bar_dur*4)
+    # to fade out background by verse start
+    fade1_end_frame = verse1_start_frame
+    mask_fade1_pct = np.linspace(1, 0, num=fade1_end_frame - mask_start_frame)
+    # fade in waves over dancer by verse start
+    waves_fade_in1_pct = np.linspace(0, 1, num=fade1_end_frame - dancer_entrance_frame)
+    mask_fade2_pct = np.linspace(0, 0.9, num=fade2_end_frame - fade2_start_frame)
+
+    # on the 2nd verse, the fire trail grows with the guitar crashes
+    # and shrinks as they fade
+    fire_trail_memory = oscillate(
+        0, fire_trail_max_memory, fire_trail_memory_fade,
+        num_frames=fire_trail_dur, offset=-1
+    ).astype(int)
+
+    schedule = {
+        'source'         : np.full(total_frames, RENDER),
+        'wave_offset'    : np.full(total_frames, -1),
+        'wave_is_slow'   : np.full(total_frames, False),
+        'waves_pct'      : np.full(total_frames, np.nan),
+        'mask_frame'     : np.full(total_frames, -1),
+        'background_pct' : np.full(total_frames, np.nan),
+        'trail_len'      : np.zeros(total_frames, dtype=int),
+        'trail_push'     : np.full(total_frames, False),
+    }
+
+    fire_section = 0
+    last_mask_frame = -1
+    trail_history_len = 0
+    for frame_num in range(total_frames):
+        fire_section_start, dancer_rates, num_fire_frames = fire_sections[fire_section]
+        fire_section_start_frame = s_to_f(fire_section_start)
+        fire_section_end_frame = fire_section_start_frame + len(dancer_rates)
+        is_fire_section = frame_num >= fire_section_start_frame and frame_num < fire_section_end_frame
+        if is_fire_section:
+            if frame_num == fire_section_start_frame:
+                dancer_frame_count = 0
+                fire_frame_count = 0
+            if frame_num == fire_section_end_frame - 1 and fire_section + 1 < len(fire_sections):
+                fire_section += 1
+
+            num_dancer_frames = dancer_rates[frame_num - fire_section_start_frame]
+            is_fire = dancer_frame_count >= num_dancer_frames
+            if is_fire:
+                fire_frame_count += 1
+                if fire_frame_count >= num_fire_frames:
+                    dancer_frame_count = 0
+                    fire_frame_count = 0
+                schedule['source'][frame_num] = FIRE
+                continue
+
+            dancer_frame_count += 1
+
+        # before dancer enters,
+        # and after cut to multiple dancers,
+        # just copy the original image
+        if frame_num < dancer_entrance_frame or frame_num >= s_to_f(synth_arp_start):
+            schedule['source'][frame_num] = COPY
+            continue
+
+        # after dancer enters, blend waves with dancer
+        if frame_num < fade2_start_frame:
+            schedule['wave_offset'][frame_num] = frame_num - dancer_entrance_frame
+        else:
+            schedule['wave_offset'][frame_num] = frame_num - fade2_start_frame
+            schedule['wave_is_slow'][frame_num] = True
+        if frame_num < fade1_end_frame:
+            schedule['waves_pct'][frame_num] = waves_fade_in1_pct[frame_num - dancer_entrance_frame]
+
+        # before we have the dancer mask, just write the blended image
+        if frame_num < mask_start_frame:
+            continue
+
+        # at the first verse, start choosing dancer masks randomly
+        # within a window around the playhead
+        if frame_num < verse1_start_frame:
+            mask_frame = frame_num
+        else:
+            dancer_deviation = random_deviation[frame_num - verse1_start_frame]
+            mask_frame = frame_num + dancer_deviation
+            mask_frame = max(mask_frame, 0)
+            mask_frame = min(mask_frame, total_frames)
+        # if the pose wasn't found, use the last mask available
+        if mask_exists(mask_frame+1):
+            last_mask_frame = mask_frame
+        if last_mask_frame < 0:
+            raise ValueError(f'No dancer mask found for frame {frame_num+1}')
+        schedule['mask_frame'][frame_num] = last_mask_frame
+
+        # fade out the background
+        if frame_num < fade1_end_frame:
+            schedule['background_pct'][frame_num] = mask_fade1_pct[frame_num - mask_start_frame]
+        elif fade2_start_frame <= frame_num < fade2_end_frame:
+            schedule['background_pct'][frame_num] = mask_fade2_pct[frame_num - fade2_start_frame]
+
+        # on the 2nd verse, make a fire motion trail
+        if fire_trail_start <= frame_num < fire_trail_end:
+            schedule['trail_len'][frame_num] = min(
+                fire_trail_memory[frame_num - fire_trail_start],
+                trail_history_len
+            )
+            schedule['trail_push'][frame_num] = True
+            trail_history_len = min(trail_history_len + 1, fire_trail_max_memory)
+
+    return schedule
+
+
+def get_mask_need_set():
+    '''
+    The dancer frame numbers interweave can take masks from:
+    the ones it picks when every frame has a mask
+    (when one turns out not to, it falls back to an earlier one of these).
+    '''
+    schedule = plan_interweave(mask_exists=lambda frame_num: True)
+    mask_frames = schedule['mask_frame']
+    return np.unique(mask_frames[mask_frames >= 0]) + 1
+
+
+def get_trail_warmup(schedule, start_frame):
+    '''
+    The frames whose masks are in the fire trail history
+    when rendering starts at `start_frame`, oldest first.
+    '''
+    pushed = np.flatnonzero(schedule['trail_push'][:start_frame])
+    return pushed[-fire_trail_max_memory:]
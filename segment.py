@@ -1,5 +1,8 @@
+import hashlib
+from multiprocessing import Pool
 import os
-import subprocess
+import sys
+import time
 
 import cv2
 import mediapipe as mp
@@ -7,58 +10,437 @@ mp_pose = mp.solutions.pose
 import numpy as np
 from tqdm import tqdm
 
+from blend import blend
 from params import *
+from schedule import get_mask_need_set
 
 
+pose_params = {
+    'enable_segmentation'      : True,
+    'min_detection_confidence' : 0.2,
+    'min_tracking_confidence'  : 0.2,
+    'model_complexity'         : 2,
+}
+# each worker segments a contiguous run of frames (at most this long),
+# after running the frames just before it through the model to warm up the tracking
+shard_frames = 200
+warmup_frames = 8
+# the smallest left outro dancer mask that's usable (at full resolution)
+min_left_mask_sum = 25000
+# segmentation runs on frames scaled down by this much,
+# and the masks are stored at that size.
+# they get blurred when they're used anyway, so the detail isn't missed much
+# (see the benchmark at the bottom)
+inference_scale = 0.5
+# run the model on every keyframe_interval'th frame (1 is every frame),
+# or sooner once a frame differs from the last keyframe by more than keyframe_max_change
+# (the mean absolute difference, 0-255, e.g. from a cut or fast motion).
+# the masks in between follow the optical flow from the keyframes around them
+# (python segment.py keyframes ... compares this to running every frame)
+keyframe_interval = 1
+keyframe_max_change = 6
+# masks are kept between runs by what they were segmented from,
+# so only frames that changed (or weren't needed before) get segmented again
+mask_cache_dir = 'media/mask_cache'
+
 def get_dancer_mask(poser, img):
     return poser.process(cv2.cvtColor(img, cv2.COLOR_BGR2RGB)).segmentation_mask
 
 
-def save_dancer_masks():
-    if os.path.exists('media/frames/dancers_mask'):
-        return
-    prinnit('Collecting dancer pose masks...')
-    subprocess.run('mkdir -p media/frames/dancers_mask', check=True, shell=True)
+def get_mask_shape(scale):
+    height, width = frame_shape
+    # keep the width even, so the outro halves line up
+    return (round(height * scale), 2 * round(width / 2 * scale))
 
-    pose_params = {
-        'enable_segmentation'      : True,
-        'min_detection_confidence' : 0.2,
-        'min_tracking_confidence'  : 0.2,
-        'model_complexity'         : 2,
-    }
 
-    # 1. single dancer in frame, up to the bridge synth arp.
+def scale_frame(img, shape):
+    if img.shape[:2] == tuple(shape):
+        return img
+    return cv2.resize(img, (shape[1], shape[0]), interpolation=cv2.INTER_AREA)
+
+
+def get_frame_change(gray, key_gray):
+    return np.mean(cv2.absdiff(gray, key_gray))
+
+
+def propagate_mask(flow_finder, mask, gray, key_gray):
+    '''
+    Warp a keyframe's mask onto another frame (both as grayscale),
+    following the optical flow from the frame to the keyframe.
+    '''
+    flow = flow_finder.calc(gray, key_gray, None)
+    height, width = gray.shape
+    xs, ys = np.meshgrid(np.arange(width, dtype=np.float32), np.arange(height, dtype=np.float32))
+    return cv2.remap(mask, xs + flow[..., 0], ys + flow[..., 1], cv2.INTER_LINEAR)
+
+
+def interpolate_mask(flow_finder, gray, frame_index, prev_key, next_key):
+    '''
+    The mask for a frame between two (index, gray, mask) keyframes:
+    both keyframe masks warped onto it, weighted by how close they are.
+    '''
+    masks = []
+    weights = []
+    for (key_index, key_gray, key_mask), other_index in ((prev_key, next_key[0]), (next_key, prev_key[0])):
+        if key_mask is not None:
+            masks.append(propagate_mask(flow_finder, key_mask, gray, key_gray))
+            weights.append(abs(other_index - frame_index))
+    if not masks:
+        return None
+    return sum(weight * mask for weight, mask in zip(weights, masks)) / sum(weights)
+
+
+def segment_frames(poser, frames, num_frames, interval=None, max_change=None):
+    '''
+    Pose segmentation masks (or None) for `num_frames` images from the iterable `frames`,
+    yielded as (index, mask) in order.
+    With a keyframe `interval` (default: keyframe_interval) over 1,
+    only keyframes go through the model (see keyframe_interval, keyframe_max_change),
+    and the last frame is always one.
+    '''
+    interval = interval or keyframe_interval
+    max_change = keyframe_max_change if max_change is None else max_change
+    # DIS is quick, and (unlike Farneback) keeps up with a dancer moving across the frame
+    flow_finder = cv2.DISOpticalFlow_create(cv2.DISOPTICAL_FLOW_PRESET_FAST)
+    prev_key = None
+    pending = []
+    for i, frame in enumerate(frames):
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        is_key = (
+            prev_key is None or i == num_frames - 1
+            or i - prev_key[0] >= interval
+            or get_frame_change(gray, prev_key[1]) > max_change
+        )
+        if not is_key:
+            pending.append((i, gray))
+            continue
+        key = (i, gray, get_dancer_mask(poser, frame))
+        for pending_index, pending_gray in pending:
+            yield pending_index, interpolate_mask(flow_finder, pending_gray, pending_index, prev_key, key)
+        pending = []
+        yield i, key[2]
+        prev_key = key
+
+
+def get_frame_hash(frame_num):
+    # the pixels, so it doesn't matter how the frame is stored
+    return hashlib.sha256(get_frame_store('dancers')[frame_num]).hexdigest()
+
+
+def get_flow_sources(frames, frame_num):
+    '''
+    The frames (of a run of consecutive frame numbers) a frame's mask can depend on:
+    with keyframes, any frame close enough to be one of its keyframes
+    (and so be propagated from), otherwise just the frame itself.
+    '''
+    reach = keyframe_interval - 1
+    return range(max(frame_num - reach, frames[0]), min(frame_num + reach, frames[-1]) + 1)
+
+
+def get_mask_key(frame_hashes, side, min_mask_sum):
+    '''
+    What a mask is cached under: the frames it comes from (see get_flow_sources)
+    and everything about how it was segmented.
+    '''
+    hasher = hashlib.sha256()
+    for frame_hash in frame_hashes:
+        hasher.update(frame_hash.encode())
+    settings = (pose_params, inference_scale, keyframe_interval, keyframe_max_change, side, min_mask_sum)
+    hasher.update(repr(settings).encode())
+    return hasher.hexdigest()
+
+
+def get_cache_path(key):
+    return os.path.join(mask_cache_dir, f'{key}.npz')
+
+
+def load_cached_mask(key):
+    '''
+    The quantized mask cached under `key`, an empty array if the frame had no usable mask,
+    or None if it hasn't been segmented.
+    '''
+    path = get_cache_path(key)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as cached:
+        return cached['mask']
+
+
+def save_cached_mask(key, mask):
+    os.makedirs(mask_cache_dir, exist_ok=True)
+    path = get_cache_path(key)
+    tmp_path = f'{path}.{os.getpid()}.npz'
+    np.savez_compressed(tmp_path, mask=np.zeros(0, dtype='uint8') if mask is None else mask)
+    os.replace(tmp_path, path)
+
+
+def get_shards(frames, keys, side=None, min_mask_sum=None):
+    '''
+    Split the frames (of a run of consecutive frame numbers) that need segmenting
+    (`keys`: frame number -> cache key) into tasks for segment_shard.
+    Frames close together go in the same shard, with the ones in between
+    just keeping the tracking going.
+    '''
+    positions = { frame_num: i for i, frame_num in enumerate(frames) }
+    runs = []
+    for i in sorted(positions[frame_num] for frame_num in keys):
+        if runs and i - runs[-1][1] <= warmup_frames and i - runs[-1][0] < shard_frames:
+            runs[-1][1] = i
+        else:
+            runs.append([i, i])
+    shards = []
+    for first, last in runs:
+        if first:
+            warmup = frames[max(first - warmup_frames, 0):first]
+        else:
+            # nothing comes before the first frame, so warm up on the frames themselves
+            warmup = frames[:warmup_frames]
+        run = frames[first:last+1]
+        shards.append({
+            'warmup'       : warmup,
+            'frames'       : run,
+            'keys'         : { frame_num: keys[frame_num] for frame_num in run if frame_num in keys },
+            'side'         : side,
+            'min_mask_sum' : min_mask_sum,
+        })
+    return shards
+
+
+def get_side_cols(volume, side):
+    half_width = volume.shape[2] // 2
+    return slice(None) if side is None else slice(side*half_width, (side+1)*half_width)
+
+
+def segment_shard(shard):
+    '''
+    Run pose segmentation over a shard's frames, writing the usable masks into the mask volume
+    and caching the results of the frames that have cache keys.
+    `side` is None for whole frames, or 0/1 for the left/right half.
+    Returns the side, the frame numbers that got a mask, and how many frames it segmented.
+    '''
+    volume = open_mask_volume()
+    side = shard['side']
+    cols = get_side_cols(volume, side)
+    shape = volume[0, :, cols].shape
+    found = []
+    frames = shard['warmup'] + shard['frames']
+    num_warmup = len(shard['warmup'])
+
+    dancers = get_frame_store('dancers')
+
+    def read_frames():
+        for frame_num in frames:
+            dancer = dancers[frame_num]
+            if side is not None:
+                dancer = np.hsplit(dancer, 2)[side]
+            yield scale_frame(dancer, shape)
+
     with mp_pose.Pose(**pose_params) as pose:
-        for frame_num in trange(dancer_entrance_frame, s_to_f(synth_arp_start)):
-            out_frame = frame_num + 1
-            dancer = cv2.imread(f'media/frames/dancers/{out_frame:06d}.png')
-            mask = get_dancer_mask(pose, dancer)
+        for i, mask in segment_frames(pose, read_frames(), len(frames)):
+            frame_num = frames[i]
+            if i < num_warmup or frame_num not in shard['keys']:
+                continue
+            if mask is not None and shard['min_mask_sum'] is not None:
+                if np.sum(mask) <= shard['min_mask_sum']:
+                    mask = None
             if mask is not None:
-                np.save(f'media/frames/dancers_mask/{out_frame:06d}.npy', mask)
+                mask = quantize_mask(mask)
+                volume[frame_num-1, :, cols] = mask
+                found.append(frame_num)
+            save_cached_mask(shard['keys'][frame_num], mask)
+    volume.flush()
+    return side, found, len(shard['keys'])
+
+
+def fill_missing_masks(volume, frames, found, side):
+    '''
+    Give the frames of one outro half without a usable mask the last one available
+    (and the frames before the first one the first one).
+    '''
+    cols = get_side_cols(volume, side)
+    found = set(found)
+    if not found:
+        raise ValueError(f'No pose found for the {["left", "right"][side]} outro dancer')
+    last = next(frame_num for frame_num in frames if frame_num in found)
+    for frame_num in frames:
+        if frame_num in found:
+            last = frame_num
+        else:
+            volume[frame_num-1, :, cols] = volume[last-1, :, cols]
 
-    # 2. two dancers in the frame, outro.
+
+def save_dancer_masks(processes=None):
+    '''
+    Segment the dancer in the frames whose masks get used
+    (reusing the masks of frames segmented the same way before).
+    '''
+    prinnit('Collecting dancer pose masks...')
+    num_frames = get_num_dancer_frames()
+    volume, index = create_mask_store(num_frames, get_mask_shape(inference_scale))
+
+    # 1. single dancer in frame, up to the bridge synth arp.
+    # only the frames interweave takes masks from
+    single_frames = list(range(dancer_entrance_frame+1, s_to_f(synth_arp_start)+1))
+    needed = set(get_mask_need_set().tolist()) & set(single_frames)
+    single_needed = [ frame_num for frame_num in single_frames if frame_num in needed ]
+
+    # 2. two dancers in the frame, outro, until they fade away.
     # mediapipe's pose segmentation does not support multiple people,
     # but luckily the dancers are mirrored,
     # so we split it into two images exactly in the middle
-    # and run pose segmentation on each half,
+    # and run pose segmentation on each half (in separate workers),
     # then piece together the full mask.
-    with mp_pose.Pose(**pose_params) as pose_left, mp_pose.Pose(**pose_params) as pose_right:
-        # the first several frames have missed detections
-        # so we put the frame with the first successful detection in front...
-        frames = list(range(s_to_f(outro_start)+1, get_num_dancer_frames()+1))
-        frames = [frames.pop(3), *frames]
-        for frame_num in tqdm(frames):
-            in_path = f'media/frames/dancers/{frame_num:06d}.png'
-            dancers = cv2.imread(in_path)
-            dancer_left, dancer_right = np.hsplit(dancers, 2)
-            mask = get_dancer_mask(pose_left, dancer_left)
-            mask_sum = -1 if mask is None else np.sum(mask)
-            # the left dancer has some super faint masks...skip em
-            # if the mask is unusable, we'll use the last one
-            if mask_sum > 25000:
-                mask_left = mask
-            mask = get_dancer_mask(pose_right, dancer_right)
-            if mask is not None:
-                mask_right = mask
-            full_mask = np.hstack((mask_left, mask_right))
-            np.save(f'media/frames/dancers_mask/{frame_num:06d}.npy', full_mask)
+    outro_frames = list(range(s_to_f(outro_start)+1, num_frames+1))
+    outro_needed = outro_frames[:outro_dancers_end_frame-1]
+    # the left dancer has some super faint masks...skip em
+    min_mask_sum = min_left_mask_sum * inference_scale**2
+
+    sections = [
+        (single_frames, single_needed, None, None),
+        (outro_frames, outro_needed, 0, min_mask_sum),
+        (outro_frames, outro_needed, 1, None),
+    ]
+    found = { None: [], 0: [], 1: [] }
+    processes = processes or get_thread_budget()
+    with Pool(processes, cv2.setNumThreads, (1,)) as pool:
+        sources = sorted({
+            source
+            for frames, frames_needed, _, _ in sections
+            for frame_num in frames_needed
+            for source in get_flow_sources(frames, frame_num)
+        })
+        frame_hashes = dict(zip(sources, pool.map(get_frame_hash, sources, chunksize=32)))
+        shards = []
+        num_cached = 0
+        for frames, frames_needed, side, min_sum in sections:
+            cols = get_side_cols(volume, side)
+            keys = {}
+            for frame_num in frames_needed:
+                key = get_mask_key(
+                    [ frame_hashes[source] for source in get_flow_sources(frames, frame_num) ],
+                    side, min_sum
+                )
+                mask = load_cached_mask(key)
+                if mask is None:
+                    keys[frame_num] = key
+                    continue
+                num_cached += 1
+                if mask.size:
+                    volume[frame_num-1, :, cols] = mask
+                    found[side].append(frame_num)
+            shards += get_shards(frames, keys, side, min_sum)
+        num_segment = sum(len(shard['keys']) for shard in shards)
+        print(f'{num_cached} masks from the cache, {num_segment} to segment')
+
+        # the masks go straight into the volume, so make sure it's on disk for the workers
+        volume.flush()
+        with tqdm(total=num_segment) as progress:
+            for side, frames, num_frames in pool.imap_unordered(segment_shard, shards):
+                found[side] += frames
+                progress.update(num_frames)
+
+    for frame_num in found[None]:
+        index_mask(volume, index, frame_num)
+    # if a half's mask is unusable, we use the last one
+    for side in (0, 1):
+        fill_missing_masks(volume, outro_needed, found[side], side)
+    for frame_num in outro_needed:
+        index_mask(volume, index, frame_num)
+
+    close_mask_store(volume, index)
+
+
+def benchmark(start_frame, num_frames, scale=None):
+    '''
+    Time segmentation of a run of dancer frames at full size and at `scale`
+    (default: inference_scale), and show how much the masks as they get used
+    (upsampled and blurred), and the dancer composited with them, differ.
+    '''
+    scale = scale or inference_scale
+    frames = range(start_frame, start_frame + num_frames)
+    dancers = get_frame_store('dancers')[start_frame:start_frame + num_frames]
+    runs = {}
+    for run_scale in (1, scale):
+        shape = get_mask_shape(run_scale)
+        masks = []
+        start = time.perf_counter()
+        with mp_pose.Pose(**pose_params) as pose:
+            for dancer in dancers:
+                masks.append(get_dancer_mask(pose, scale_frame(dancer, shape)))
+        runs[run_scale] = (masks, time.perf_counter() - start)
+        print(f'scale {run_scale}: {runs[run_scale][1] / num_frames * 1000:.1f}ms/frame, '
+              f'{np.prod(shape) / 2**20:.2f}MB/mask')
+
+    mask_diffs = []
+    frame_diffs = []
+    for frame_num, dancer, full, small in zip(frames, dancers, runs[1][0], runs[scale][0]):
+        if full is None or small is None:
+            continue
+        alphas = []
+        for mask in (full, small):
+            mask = quantize_mask(mask)
+            bbox = get_mask_bbox(mask)
+            if mask.shape != frame_shape:
+                mask, bbox = upsample_mask(mask, bbox, frame_num)
+            alphas.append(blur_mask(mask, bbox))
+        mask_diffs.append(np.abs(alphas[0].astype(int) - alphas[1]))
+        composites = [ blend(alpha, dancer, 0).astype(int) for alpha in alphas ]
+        frame_diffs.append(np.mean((composites[0] - composites[1])**2))
+    if not mask_diffs:
+        print('No frames with masks at both scales')
+        return
+    mask_diffs = np.array(mask_diffs)
+    psnr = 10 * np.log10(255**2 / max(np.mean(frame_diffs), 1e-9))
+    print(f'speedup: {runs[1][1] / runs[scale][1]:.2f}x')
+    print(f'mask difference: mean {mask_diffs.mean():.2f}, max {mask_diffs.max()} (of 255)')
+    print(f'composited frames: {psnr:.1f}dB PSNR ({mask_upsampling} upsampling)')
+
+
+def compare_keyframes(start_frame, num_frames, interval=None):
+    '''
+    Time segmentation of a run of dancer frames (at inference_scale)
+    with every frame as a keyframe and with keyframes every `interval` frames
+    (default: keyframe_interval), and show the IoU of the keyframed masks with the full-rate ones.
+    '''
+    interval = interval or keyframe_interval
+    shape = get_mask_shape(inference_scale)
+    dancers = [
+        scale_frame(dancer, shape)
+        for dancer in get_frame_store('dancers')[start_frame:start_frame + num_frames]
+    ]
+    runs = {}
+    for run_interval in (1, interval):
+        start = time.perf_counter()
+        with mp_pose.Pose(**pose_params) as pose:
+            masks = [ mask for _, mask in segment_frames(pose, dancers, num_frames, run_interval) ]
+        runs[run_interval] = (masks, time.perf_counter() - start)
+        print(f'every {run_interval} frames: {runs[run_interval][1] / num_frames * 1000:.1f}ms/frame')
+
+    ious = []
+    for full, keyframed in zip(runs[1][0], runs[interval][0]):
+        if full is None or keyframed is None:
+            continue
+        full, keyframed = full > 0.5, keyframed > 0.5
+        union = np.count_nonzero(full | keyframed)
+        ious.append(np.count_nonzero(full & keyframed) / union if union else 1)
+    if not ious:
+        print('No frames with masks in both runs')
+        return
+    print(f'speedup: {runs[1][1] / runs[interval][1]:.2f}x')
+    print(f'mask IoU: mean {np.mean(ious):.3f}, min {np.min(ious):.3f}, '
+          f'{np.mean(np.array(ious) < 0.9) * 100:.1f}% of frames under 0.9')
+
+
+if __name__ == '__main__':
+    # python segment.py [start frame] [number of frames] [scale]
+    # python segment.py keyframes [start frame] [number of frames] [interval]
+    args = sys.argv[1:]
+    compare = args[:1] == ['keyframes']
+    if compare:
+        args = args[1:]
+    start_frame = int(args[0]) if args else dancer_entrance_frame + 1
+    num_frames = int(args[1]) if len(args) > 1 else 150
+    if compare:
+        compare_keyframes(start_frame, num_frames, int(args[2]) if len(args) > 2 else 4)
+    else:
+        benchmark(start_frame, num_frames, float(args[2]) if len(args) > 2 else None)
@@ -0,0 +1,282 @@
+import hashlib
+import inspect
+import json
+from multiprocessing import Process
+from multiprocessing.connection import wait
+import os
+import shutil
+import sys
+import types
+
+import cv2
+import numpy as np
+
+
+# the key each stage was last built with
+stages_file = 'media/stages.json'
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+# modules that only affect how progress is displayed,
+# so changing them shouldn't re-render anything
+untracked_modules = ['multisubprocess', 'stages']
+
+# name -> stage declaration, in the order they were declared
+pipeline = {}
+# how many threads all the running stages can use between them
+max_threads = os.cpu_count()
+# how many threads the stage running in this process can use
+# (None when we're not running a stage)
+stage_threads = None
+
+def stage(outputs, deps=(), inputs=(), seed=None, threads=None):
+    '''
+    Declare a function as a pipeline stage.
+    `outputs` are the files/dirs it writes (removed before it re-runs),
+    `deps` are the names of the stages whose outputs it reads,
+    `inputs` are source media files it reads,
+    `seed` is the np.random seed set before it runs,
+    and `threads` is about how many cores it keeps busy
+    (None to use whatever the other ready stages leave free when it starts).
+    '''
+    def register(func):
+        pipeline[func.__name__] = {
+            'func'    : func,
+            'outputs' : list(outputs),
+            'deps'    : list(deps),
+            'inputs'  : list(inputs),
+            'seed'    : seed,
+            'threads' : threads,
+        }
+        return func
+    return register
+
+
+def get_thread_budget():
+    '''
+    How many threads the running stage should use
+    (for ffmpeg's -threads, Pool sizes and such).
+    None if we're not running a stage, meaning no limit.
+    '''
+    return stage_threads
+
+
+def is_tracked(func):
+    '''
+    Only hash the code that lives in this repo
+    (library code changes with the environment, not the edit).
+    '''
+    module = sys.modules.get(func.__module__)
+    module_file = getattr(module, '__file__', None)
+    if module_file is None or func.__module__ in untracked_modules:
+        return False
+    return os.path.dirname(os.path.abspath(module_file)) == repo_dir
+
+
+def get_global_names(code):
+    '''
+    All the global names a code object (and its nested comprehensions/functions) reads.
+    '''
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= get_global_names(const)
+    return names
+
+
+def hash_value(hasher, value):
+    if isinstance(value, np.ndarray):
+        hasher.update(f'{value.dtype}{value.shape}'.encode())
+        hasher.update(np.ascontiguousarray(value).tobytes())
+    else:
+        hasher.update(repr(value).encode())
+
+
+def hash_code(hasher, code, seen):
+    '''
+    Hash a function's or class's source, the params it reads,
+    and (recursively) the source of every repo function and class it uses.
+    '''
+    seen.add(code)
+    hasher.update(inspect.getsource(code).encode())
+    if isinstance(code, type):
+        # what its methods use, and the repo classes it builds on
+        for name, attr in sorted(vars(code).items()):
+            # static/class methods keep their function in __func__
+            method = inspect.unwrap(getattr(attr, '__func__', attr))
+            if isinstance(method, types.FunctionType) and method not in seen:
+                hash_code(hasher, method, seen)
+        for base in code.__bases__:
+            if base not in seen and is_tracked(base):
+                hash_code(hasher, base, seen)
+        return
+    for name in sorted(get_global_names(code.__code__)):
+        if name not in code.__globals__:
+            continue
+        value = code.__globals__[name]
+        # see thru decorators like lru_cache to the function they wrap
+        if callable(value):
+            value = inspect.unwrap(value)
+        if isinstance(value, (types.FunctionType, type)):
+            if value not in seen and is_tracked(value):
+                hash_code(hasher, value, seen)
+        elif not (callable(value) or isinstance(value, types.ModuleType)):
+            hasher.update(name.encode())
+            hash_value(hasher, value)
+
+
+def hash_input(hasher, path):
+    '''
+    Source media is big, so identify it by its size and modification time.
+    '''
+    hasher.update(path.encode())
+    if os.path.exists(path):
+        stat = os.stat(path)
+        hasher.update(f'{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    else:
+        hasher.update(b'missing')
+
+
+def get_stage_order():
+    '''
+    Sort the stages so each one comes after its deps
+    (otherwise keeping the declared order).
+    '''
+    order = []
+    def visit(name, path=()):
+        if name in order:
+            return
+        if name in path:
+            raise ValueError(f'Stage dependency cycle: {" -> ".join((*path, name))}')
+        for dep in pipeline[name]['deps']:
+            visit(dep, (*path, name))
+        order.append(name)
+    for name in pipeline:
+        visit(name)
+    return order
+
+
+def get_stage_keys():
+    '''
+    Each stage's key is a hash of its code, the params it reads,
+    its seed, its source media, and the keys of the stages it depends on.
+    '''
+    keys = {}
+    for name in get_stage_order():
+        declaration = pipeline[name]
+        hasher = hashlib.sha256()
+        hasher.update(name.encode())
+        hash_code(hasher, declaration['func'], set())
+        hasher.update(repr(declaration['seed']).encode())
+        for path in declaration['inputs']:
+            hash_input(hasher, path)
+        for dep in declaration['deps']:
+            hasher.update(keys[dep].encode())
+        keys[name] = hasher.hexdigest()
+    return keys
+
+
+def load_built_keys():
+    if not os.path.exists(stages_file):
+        return {}
+    with open(stages_file, 'r') as f:
+        return json.load(f)
+
+
+def save_built_keys(built_keys):
+    os.makedirs(os.path.dirname(stages_file), exist_ok=True)
+    with open(stages_file, 'w') as f:
+        json.dump(built_keys, f, indent=2)
+
+
+def remove_outputs(outputs):
+    for path in outputs:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+
+def run_stage(name, threads):
+    '''
+    Run a stage in this (new) process, within its thread budget.
+    '''
+    global stage_threads
+    stage_threads = threads
+    cv2.setNumThreads(threads)
+    declaration = pipeline[name]
+    if declaration['seed'] is not None:
+        np.random.seed(declaration['seed'])
+    declaration['func']()
+
+
+def run_stages():
+    '''
+    Run every stage whose key changed (or whose outputs are missing),
+    plus everything downstream of it.
+    Stages whose deps are done run in parallel (each in its own process),
+    as long as their thread estimates fit in max_threads.
+    '''
+    keys = get_stage_keys()
+    built_keys = load_built_keys()
+    pending = []
+    for name in get_stage_order():
+        declaration = pipeline[name]
+        is_built = (
+            built_keys.get(name) == keys[name]
+            and all(map(os.path.exists, declaration['outputs']))
+            and not any(dep in pending for dep in declaration['deps'])
+        )
+        if is_built:
+            print(f'{name} is up to date')
+            continue
+        pending.append(name)
+        remove_outputs(declaration['outputs'])
+        # don't trust the old key if we fail partway thru
+        built_keys.pop(name, None)
+    save_built_keys(built_keys)
+
+    # name -> (process, threads)
+    running = {}
+    try:
+        while pending or running:
+            free_threads = max_threads - sum(threads for _, threads in running.values())
+            ready = [
+                name for name in pending
+                if not any(dep in pending or dep in running for dep in pipeline[name]['deps'])
+            ]
+            # start the stages with a thread estimate first,
+            # and keep room for the ones still waiting,
+            # so a threads=None stage only gets what they leave
+            ready.sort(key=lambda name: pipeline[name]['threads'] is None)
+            reserved = sum(min(pipeline[name]['threads'] or 0, max_threads) for name in ready)
+            for name in ready:
+                declared = pipeline[name]['threads']
+                if declared:
+                    threads = min(declared, max_threads)
+                else:
+                    threads = free_threads - reserved
+                # wait for room, unless nothing else is running
+                if running and (threads > free_threads or threads < 1):
+                    continue
+                if declared:
+                    reserved -= threads
+                threads = max(threads, 1)
+                process = Process(target=run_stage, args=(name, threads), name=name)
+                process.start()
+                running[name] = (process, threads)
+                pending.remove(name)
+                free_threads -= threads
+            # sleep until a stage finishes
+            sentinels = { process.sentinel: name for name, (process, _) in running.items() }
+            for sentinel in wait(list(sentinels)):
+                name = sentinels[sentinel]
+                process, _ = running.pop(name)
+                process.join()
+                if process.exitcode:
+                    raise RuntimeError(f'Stage {name} failed (exit code {process.exitcode})')
+                built_keys[name] = keys[name]
+                save_built_keys(built_keys)
+    finally:
+        # stop everything else if a stage failed
+        for process, _ in running.values():
+            process.terminate()
+            process.join()
@@ -0,0 +1,205 @@
+import mmap
+import os
+
+import numpy as np
+
+
+# macroblocks without a vector (e.g. intra blocks) are null in ffedit's JSON,
+# so they're parsed as this before being masked out
+null_vector = b'[-32768,-32768]'
+null_value = -32768
+
+def get_nesting_depth(data, depth=0):
+    '''
+    The JSON nesting depth after each byte of `data`
+    (ffedit's motion vector exports have no brackets inside strings).
+    '''
+    data = np.frombuffer(data, dtype=np.uint8)
+    delta = np.zeros(len(data), dtype=np.int8)
+    delta[(data == ord('[')) | (data == ord('{'))] = 1
+    delta[(data == ord(']')) | (data == ord('}'))] = -1
+    return np.cumsum(delta, dtype=np.int32) + depth
+
+
+def find_frame_spans(mm, block_size=1 << 22):
+    '''
+    The (start, end) of every object in the "frames" array of an ffedit export,
+    scanning a block at a time so nothing but the spans is kept in memory.
+    '''
+    array_start = mm.find(b'[', mm.find(b'"frames"'))
+    spans = []
+    frame_start = None
+    pos = array_start
+    # depth 1 is inside the frames array, depth 2 is inside a frame
+    depth = 0
+    while pos < len(mm):
+        block = mm[pos:pos+block_size]
+        depths = get_nesting_depth(block, depth)
+        data = np.frombuffer(block, dtype=np.uint8)
+        starts = np.flatnonzero((data == ord('{')) & (depths == 2))
+        ends = np.flatnonzero((data == ord('}')) & (depths == 1)) + 1
+        closed = np.flatnonzero(depths == 0)
+        if len(closed):
+            starts = starts[starts < closed[0]]
+            ends = ends[ends <= closed[0]]
+        # a frame can start in one block and end in the next
+        if frame_start is not None:
+            starts = np.concatenate([[frame_start - pos], starts])
+        spans.extend(zip(pos + starts[:len(ends)], pos + ends))
+        frame_start = pos + starts[-1] if len(starts) > len(ends) else None
+        if len(closed):
+            break
+        depth = int(depths[-1])
+        pos += block_size
+    return [ (int(start), int(end)) for start, end in spans ]
+
+
+def parse_frame_vectors(frame):
+    '''
+    The forward vectors of one ffedit frame object as an int16 (rows, cols, 2) array,
+    and a (rows, cols) mask of the macroblocks that have one.
+    Returns None if the frame has no forward vectors.
+    '''
+    key = frame.find(b'"forward"')
+    if key < 0:
+        return None
+    start = frame.find(b':', key) + 1
+    while frame[start:start+1].isspace():
+        start += 1
+    if frame[start:start+1] != b'[':
+        return None
+    depths = get_nesting_depth(frame[start:])
+    end = start + int(np.argmax(depths == 0)) + 1
+    text = frame[start:end]
+    depths = depths[:end-start]
+    data = np.frombuffer(text, dtype=np.uint8)
+    num_rows = np.count_nonzero((data == ord('[')) & (depths == 2))
+    if not num_rows:
+        return None
+    text = text.replace(b'null', null_vector).translate(None, b'[]')
+    pairs = np.fromstring(text, dtype=np.int32, sep=',').reshape(num_rows, -1, 2)
+    mask = pairs[..., 0] != null_value
+    vectors = np.where(mask[..., np.newaxis], pairs, 0).astype(np.int16)
+    return vectors, mask
+
+
+def read_ffedit_vectors(path):
+    '''
+    Parse the forward motion vectors of an ffedit `-f mv -e` export one frame at a time.
+    Returns an int16 (frames, mb_rows, mb_cols, 2) array of vectors,
+    and a bool (frames, mb_rows, mb_cols) mask of which macroblocks have one
+    (all False for frames without vectors, like iframes).
+    '''
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        spans = find_frame_spans(mm)
+        vectors = np.zeros((len(spans), 0, 0, 2), dtype=np.int16)
+        mask = np.zeros((len(spans), 0, 0), dtype=bool)
+        for frame_num, (start, end) in enumerate(spans):
+            parsed = parse_frame_vectors(mm[start:end])
+            if parsed is None:
+                continue
+            frame_vectors, frame_mask = parsed
+            # every frame has the same macroblock grid
+            if not vectors.size:
+                vectors = np.zeros((len(spans), *frame_vectors.shape), dtype=np.int16)
+                mask = np.zeros((len(spans), *frame_mask.shape), dtype=bool)
+            vectors[frame_num] = frame_vectors
+            mask[frame_num] = frame_mask
+    return vectors, mask
+
+
+def get_vector_strings(vectors, mask):
+    '''
+    Each frame's vectors as a flat "x,y,x,y,..." string in row-major order,
+    with blanks for macroblocks without a vector
+    (and an empty string for frames without any).
+    '''
+    strings = []
+    for frame_vectors, frame_mask in zip(vectors, mask):
+        if not frame_mask.any():
+            strings.append('')
+            continue
+        values = frame_vectors.astype(str)
+        values[~frame_mask] = ''
+        strings.append(','.join(values.ravel()))
+    return strings
+
+
+def resample_vectors(vectors, mask, src_size, dst_size, method='bilinear', block_size=16):
+    '''
+    Map motion vectors from the macroblock grid of a `src_size` (width, height) video
+    onto the grid of a `dst_size` one, scaling their magnitudes to match.
+    `method` is 'nearest' (copy the closest source block)
+    or 'bilinear' (blend the 4 closest blocks that have a vector).
+    '''
+    src_rows, src_cols = vectors.shape[1:3]
+    src_width, src_height = src_size
+    dst_width, dst_height = dst_size
+    dst_rows = -(-dst_height // block_size)
+    dst_cols = -(-dst_width // block_size)
+    # the target macroblock centers, in source macroblocks
+    ys = (np.arange(dst_rows) + 0.5) * src_height / dst_height - 0.5
+    xs = (np.arange(dst_cols) + 0.5) * src_width / dst_width - 0.5
+    ys = np.clip(ys, 0, src_rows - 1)
+    xs = np.clip(xs, 0, src_cols - 1)
+    if method == 'nearest':
+        rows = np.rint(ys).astype(int)[:, np.newaxis]
+        cols = np.rint(xs).astype(int)[np.newaxis, :]
+        resampled = vectors[:, rows, cols].astype(float)
+        resampled_mask = mask[:, rows, cols]
+    elif method == 'bilinear':
+        y0 = np.floor(ys).astype(int)
+        x0 = np.floor(xs).astype(int)
+        y1 = np.minimum(y0 + 1, src_rows - 1)
+        x1 = np.minimum(x0 + 1, src_cols - 1)
+        wy = ys - y0
+        wx = xs - x0
+        total = np.zeros((len(vectors), dst_rows, dst_cols, 2))
+        total_weight = np.zeros((len(vectors), dst_rows, dst_cols))
+        for rows, row_weight in ((y0, 1 - wy), (y1, wy)):
+            for cols, col_weight in ((x0, 1 - wx), (x1, wx)):
+                rows_, cols_ = rows[:, np.newaxis], cols[np.newaxis, :]
+                # blocks without a vector don't count
+                weight = np.outer(row_weight, col_weight) * mask[:, rows_, cols_]
+                total += weight[..., np.newaxis] * vectors[:, rows_, cols_]
+                total_weight += weight
+        resampled_mask = total_weight > 0
+        resampled = total / np.maximum(total_weight, 1e-9)[..., np.newaxis]
+    else:
+        raise ValueError(f'Unknown resampling method: {method}')
+    # vectors are [x, y] in pixels (or fractions of them)
+    resampled *= (dst_width / src_width, dst_height / src_height)
+    resampled[~resampled_mask] = 0
+    return np.rint(resampled).astype(np.int16), resampled_mask
+
+
+# motion vectors extracted from source clips, by what they were extracted from
+vector_cache_dir = 'media/mv_cache'
+
+def get_cache_path(key):
+    return os.path.join(vector_cache_dir, f'{key}.npz')
+
+
+def has_cached_vectors(key):
+    return os.path.exists(get_cache_path(key))
+
+
+def load_cached_vectors(key):
+    '''
+    The (vectors, mask) cached under `key`, or None if there aren't any.
+    '''
+    path = get_cache_path(key)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as cached:
+        return cached['vectors'], cached['mask']
+
+
+def save_cached_vectors(key, vectors, mask):
+    os.makedirs(vector_cache_dir, exist_ok=True)
+    path = get_cache_path(key)
+    # parallel chunks can extract the same clip,
+    # so write somewhere else first and move it into place
+    tmp_path = f'{path}.{os.getpid()}.npz'
+    np.savez_compressed(tmp_path, vectors=vectors, mask=mask)
+    os.replace(tmp_path, path)